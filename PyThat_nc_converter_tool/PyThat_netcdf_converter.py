@@ -1,10 +1,96 @@
-from sys import argv
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+from json import dump
+from multiprocessing import freeze_support
+from os import cpu_count
+from time import perf_counter
 from PyThat import MeasurementTree
 import pathlib
+import sys
 
-try:
-    path = pathlib.Path(argv[1]).absolute()
-except IndexError:
-    print(r'Please specifiy a full path, e.g. D:\files\my_data.h5')
-    path = pathlib.Path(input()).absolute()
-MeasurementTree(path, override=True, index=True)
+
+def collect_files(paths):
+    """Expand directories and glob patterns to a sorted list of .h5 files, whatever the case of the suffix. Files which
+    are given explicitly are kept with any suffix. Returns the files and the list of entries without any file."""
+    files = set()
+    missing = []
+    for entry in paths:
+        path = pathlib.Path(entry)
+        if path.is_file():
+            found = {path.absolute()}
+        else:
+            found = path.rglob('*') if path.is_dir() else [pathlib.Path(x) for x in glob(entry, recursive=True)]
+            found = {x.absolute() for x in found if x.suffix.lower() == '.h5' and x.is_file()}
+        if not found:
+            missing.append(entry)
+        files |= found
+    return sorted(files), missing
+
+
+def convert(path, force=False, stream=False, quiet=False):
+    """Convert one file, unless force is False and its .nc file was converted from the current state of the .h5 file
+    (see MeasurementTree.check_fingerprint). Returns the path, the duration, the error message or None, the timing
+    report and False if the file was up to date."""
+    start = perf_counter()
+    try:
+        mt = MeasurementTree(path, override=force, index=True, stream=stream, quiet=quiet)
+        converted = any(x['phase'] == 'write' for x in mt.phases)
+        if mt.dataset is not None:
+            mt.dataset.close()
+        return path, perf_counter() - start, None, mt.report(), converted
+    except Exception as err:
+        return path, perf_counter() - start, f'{type(err).__name__}: {err}', None, True
+
+
+if __name__ == '__main__':
+    # Required for the process pool in the frozen executable
+    freeze_support()
+    parser = ArgumentParser(description='Convert Thatec .h5 files to netcdf (.nc) files.')
+    parser.add_argument('paths', nargs='*', help='.h5 files, directories or glob patterns')
+    parser.add_argument('-j', '--workers', type=int, default=cpu_count(), help='number of parallel conversions')
+    parser.add_argument('-f', '--force', action='store_true', help='also convert files with an up to date .nc file')
+    parser.add_argument('-s', '--stream', action='store_true', help='use the streaming writer with bounded memory')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only print the summary')
+    parser.add_argument('-r', '--report', help='write the timing of the phases of each conversion to this json file')
+    args = parser.parse_args()
+
+    if not args.paths:
+        print(r'Please specifiy a full path, e.g. D:\files\my_data.h5')
+        args.paths = [input()]
+    files, missing = collect_files(args.paths)
+    for entry in missing:
+        print(f'No .h5 files found for {entry}')
+    if not files:
+        sys.exit('No files to convert.')
+    print(f'Converting {len(files)} files with {args.workers} workers'
+          f'{"" if args.force else ", skipping up to date files"}.')
+
+    results = []
+    start = perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = [pool.submit(convert, x, args.force, args.stream, args.quiet) for x in files]
+        for future in as_completed(futures):
+            results.append(future.result())
+    skipped = sorted(x[0] for x in results if not x[4])
+    results = [x for x in results if x[4]]
+
+    print()
+    print('Summary')
+    print('________________________________________________________')
+    for path, duration, error, _, _ in sorted(results, key=lambda x: x[0]):
+        print(f'{"FAILED" if error else "OK":6} {duration:8.2f} s  {path}')
+        if error:
+            print(f'       {error}')
+    for path in skipped:
+        print(f'{"SKIP":6} {"":10}  {path}')
+    failed = sum(1 for x in results if x[2])
+    print(f'{len(results) - failed} converted, {failed} failed, {len(skipped)} skipped '
+          f'in {perf_counter() - start:.2f} s')
+    if args.report:
+        with open(args.report, 'w') as file:
+            dump([x[3] for x in results if x[3] is not None], file, indent=1)
+        print(f'Timing report written to {args.report}')
+    if failed:
+        # Lets batch scripts detect failed conversions
+        sys.exit(1)
@@ -0,0 +1,57 @@
+"""
+Benchmark of the metadata catalog (PyThat.Catalog) on a directory of synthetic measurement files. Times the initial
+indexing, an update without changes and queries, and checks that every query returns each matching file exactly once,
+also if a file has several entries which fulfil a condition.
+
+Usage: python benchmarks/bench_catalog.py [number of files]
+"""
+import sys
+import tempfile
+import time
+import pathlib as pl
+from PyThat import Catalog
+from synthetic import write_synthetic
+
+# Conditions and the number of steps of a loop of the matching files, None for all files. The first two conditions
+# match several entries of each file, e.g. 'function' one row per loop.
+QUERIES = [
+    ([{'source': 'scan_definition', 'key': 'function', 'value': 'scalar control'}], None),
+    ([{'key': 'device name', 'value': 'Device%'}], None),
+    ([{'source': 'scan_definition', 'key': 'steps', 'value': 3}], 3),
+    ([{'key': 'function', 'value': 'scalar control'}, {'key': 'steps', 'low': 3, 'high': 3}], 3),
+]
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def main(files=20):
+    with tempfile.TemporaryDirectory() as directory:
+        root = pl.Path(directory)
+        loops = {}
+        for i in range(files):
+            path = root / 'data' / f'm{i:03d}.h5'
+            path.parent.mkdir(exist_ok=True)
+            loops[str(path)] = (5, 3) if i % 2 else (4, 2, 2)
+            write_synthetic(path, loops=loops[str(path)], indicators=((10,),), device_rows=10, log_rows=2, seed=i)
+        with Catalog(root / 'catalog.sqlite') as catalog:
+            t_index, result = timed(catalog.update, root / 'data')
+            if result['failed'] or len(result['added']) != files:
+                raise AssertionError(f'Indexing failed: {result}')
+            t_update, result = timed(catalog.update, root / 'data')
+            if result['unchanged'] != files:
+                raise AssertionError(f'Unchanged files were indexed again: {result}')
+            for conditions, steps in QUERIES:
+                t_find, found = timed(catalog.find, *conditions)
+                expected = sorted(x for x, shape in loops.items() if steps is None or steps in shape)
+                if found != expected:
+                    raise AssertionError(f'{conditions} returned {len(found)} paths instead of {len(expected)}')
+                print(f'find {conditions}: {len(found)} files in {t_find * 1e3:.2f} ms')
+    print(f'Indexing {files} files: {t_index:.2f} s, update without changes: {t_update * 1e3:.1f} ms')
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
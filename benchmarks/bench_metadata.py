@@ -0,0 +1,108 @@
+"""
+Benchmark of the metadata decoding in MeasurementTree.convert_to_dict and MeasurementTree.get_metadata.
+Compares the column wise decode_table with the previous element wise decoding on synthetic metadata tables. Reading
+the strings from the h5 file is the same for both and is timed separately.
+
+Usage: python benchmarks/bench_metadata.py [number of rows]
+"""
+import re
+import sys
+import tempfile
+import time
+import pathlib as pl
+import h5py
+import numpy as np
+from PyThat import MeasurementTree, decode_table
+
+
+def legacy_check_for_sp_char(text):
+    special_char = re.compile(r"%%%(\d+)%%%")
+    text = str(text)
+    for v in special_char.finditer(text):
+        text = text.replace(v.group(), chr(int(v.group(1))))
+    return text
+
+
+def legacy_convert_to_dict(table, truncate=False):
+    a = {}
+    for x in table:
+        test_string = x[1][1:-1] if truncate else x[1]
+        try:
+            z = float(test_string)
+        except ValueError:
+            if test_string == 'false':
+                z = False
+            elif test_string == 'true':
+                z = True
+            else:
+                z = legacy_check_for_sp_char(test_string)
+        key = legacy_check_for_sp_char(x[0])
+        if key in a:
+            q = a[key] if isinstance(a[key], list) else [a[key]]
+            q.append(z)
+            a[key] = q
+        else:
+            a[key] = z
+    return a
+
+
+def synthetic_table(rows, seed=0):
+    """Key value table with numbers, booleans, strings, %%%NN%%% escapes and duplicate keys."""
+    rng = np.random.default_rng(seed)
+    words = ['Set Magnetic Field (mT)', 'Frequency (GHz)', 'none', 'Infinity', 'nan', 'true', 'false', '', '1_000',
+             'Process paused by user.', 'Power%%%40%%%dBm%%%41%%%', 'NUL%%%0%%%escape', ' 12.5 ', '-3e-4', 'inf', 'TRUE',
+             '[5.2]', 'x']
+    table = []
+    for i in range(rows):
+        kind = rng.integers(4)
+        if kind == 0:
+            value = f'{rng.normal():.12E}'
+        elif kind == 1:
+            value = str(int(rng.integers(-1000, 1000)))
+        else:
+            value = words[rng.integers(len(words))]
+        key = f'key%%%95%%%{i}' if i % 10 == 0 else f'key_{i % (rows // 2 + 1)}'
+        table.append((key, value))
+    return table
+
+
+def convert_to_dict(table, truncate=False):
+    """Same as MeasurementTree.convert_to_dict, for an already read table."""
+    keys, values = decode_table(table, truncate=truncate)
+    a = {}
+    for key, value in zip(keys, values):
+        if key in a:
+            a[key] = (a[key] if isinstance(a[key], list) else [a[key]]) + [value]
+        else:
+            a[key] = value
+    return a
+
+
+def timed(function, *args, repeat=3, **kwargs):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(rows=100_000):
+    with tempfile.TemporaryDirectory() as directory:
+        path = pl.Path(directory) / 'metadata.h5'
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('table', data=np.array(synthetic_table(rows), dtype=object), dtype=h5py.string_dtype())
+        with h5py.File(path, 'r') as f:
+            t_read, table = timed(lambda: f['table'].asstr()[:, :])
+            print(f'Reading {rows} rows with asstr: {t_read * 1e3:.1f} ms')
+            for truncate in [False, True]:
+                t_legacy, legacy = timed(legacy_convert_to_dict, table, truncate)
+                t_new, new = timed(convert_to_dict, table, truncate)
+                if repr(legacy) != repr(new) or repr(new) != repr(MeasurementTree.convert_to_dict(f['table'], truncate)):
+                    raise AssertionError('decode_table differs from the element wise decoding')
+                print(f'Decoding {rows} rows, truncate={truncate}: '
+                      f'{t_legacy * 1e3:.1f} ms -> {t_new * 1e3:.1f} ms ({t_legacy / t_new:.1f}x)')
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
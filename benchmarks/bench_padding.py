@@ -0,0 +1,73 @@
+"""
+Benchmark of the conversion of unfinished measurements, whose missing core measurements are padded with NaN.
+Compares MeasurementTree.construct_tree with the previous order, which read the measured data before it found out that
+the measurement is unfinished and then read it again into the padded array. Checks that the data is read once and that
+the peak memory stays close to the size of the padded array.
+
+Usage: python benchmarks/bench_padding.py [number of outer steps]
+"""
+import contextlib
+import io
+import sys
+import tempfile
+import time
+import tracemalloc
+import pathlib as pl
+import numpy as np
+from PyThat import MeasurementTree
+from synthetic import write_synthetic
+
+# Allowed peak memory above the padded array, e.g. for the coordinates
+SLACK_BYTES = 2**20
+
+
+def legacy_pad(dataset, shape):
+    """Previous order: reshape the measured data, which reads it, and pad it after the reshape failed."""
+    try:
+        return np.reshape(dataset, shape)
+    except ValueError:
+        flattened_shape = (int(np.prod(shape[:-1])),) + shape[-1:]
+        return MeasurementTree.pad_data(dataset, flattened_shape).reshape(shape)
+
+
+def traced(function, *args):
+    """Wall time and peak traced memory of one call."""
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak, result
+
+
+def main(steps=200):
+    loops, points = (steps, 20), 1001
+    with tempfile.TemporaryDirectory() as directory:
+        path = pl.Path(directory) / 'incomplete.h5'
+        records = write_synthetic(path, loops=loops, indicators=((points,),), completeness=0.6, chunked=False)
+        planned = int(np.prod(loops)) * points * 8
+        with contextlib.redirect_stdout(io.StringIO()):
+            mt = MeasurementTree(path, override=True, index=False, keep_file_open=True)
+            mt.index = True
+            t_new, peak_new, _ = traced(mt.construct_tree)
+            dataset = mt.f['measurement/' + mt.indicators[mt.indicator_name].row + '/data']
+            t_legacy, peak_legacy, legacy = traced(legacy_pad, dataset, loops + (points,))
+        if not np.array_equal(legacy, mt.array.values, equal_nan=True):
+            raise AssertionError('The padded data differs from the previous padding')
+        read = sum(x['bytes_read'] for x in mt.phases if x['phase'] in ['read', 'pad'])
+        if read != dataset.size * dataset.dtype.itemsize:
+            raise AssertionError(f'{read} bytes were read instead of {dataset.size * dataset.dtype.itemsize}')
+        if peak_new > planned + SLACK_BYTES:
+            raise AssertionError(f'Peak memory of {peak_new / 1e6:.1f} MB exceeds the padded array of '
+                                 f'{planned / 1e6:.1f} MB')
+        mt.f.close()
+    print(f'{records} of {int(np.prod(loops))} core measurements, padded array {planned / 1e6:.1f} MB')
+    print(f'Padding: {t_legacy:.3f} s, {peak_legacy / 1e6:.1f} MB peak (reshape and pad only) -> '
+          f'{t_new:.3f} s, {peak_new / 1e6:.1f} MB peak (complete construct_tree)')
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
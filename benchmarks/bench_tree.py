@@ -0,0 +1,115 @@
+"""
+Benchmark of the reconstruction of the measurement tree (MeasurementTree.build_groups) on synthetic scan definitions.
+Compares the single pass builder with the previous builder, which searched the parent group and the siblings with
+nested loops over all groups, and checks that both give the same tree.
+
+Usage: python benchmarks/bench_tree.py [number of rows]
+"""
+import contextlib
+import io
+import sys
+import tempfile
+import time
+import pathlib as pl
+import h5py
+import numpy as np
+from PyThat import MeasurementTree
+from synthetic import STRING, table
+
+
+class LegacyGroup:
+    def __init__(self):
+        self.parent_group = None
+        self.parent_row = None
+        self.tree_indent = 0
+        self.group_entries = {}
+        self.siblings = []
+
+
+def legacy_build_groups(definition):
+    rows = list(definition)
+    new_tree = [LegacyGroup()]
+    previous_indent = int(definition[rows[0]]['tree indent level'])
+    for row, value in definition.items():
+        new_indent = int(value['tree indent level'])
+        if new_indent == previous_indent:
+            new_tree[-1].group_entries[row] = value
+        elif new_indent > previous_indent:
+            new_tree.append(LegacyGroup())
+            new_tree[-1].group_entries[row] = value
+            new_tree[-1].tree_indent = new_indent
+            new_tree[-1].parent_group = new_tree[-2]
+            new_tree[-1].parent_row = list(new_tree[-2].group_entries.keys())[-1]
+        else:
+            new_tree.append(LegacyGroup())
+            new_tree[-1].group_entries[row] = value
+            new_tree[-1].tree_indent = new_indent
+            red_list = list(filter(lambda x: x.tree_indent < new_indent, new_tree))
+            try:
+                new_tree[-1].parent_group = red_list[-1]
+                new_tree[-1].parent_row = list(red_list[-1].group_entries.keys())[-1]
+            except IndexError:
+                pass
+        previous_indent = new_indent
+    for i, k in enumerate(new_tree):
+        for q, j in enumerate(new_tree[i+1:None]):
+            if j.tree_indent < k.tree_indent:
+                break
+            if j.tree_indent == k.tree_indent:
+                j.siblings.append(k)
+                k.siblings.append(j)
+    return new_tree
+
+
+def structure(tree):
+    """Comparable description of a list of groups."""
+    position = {id(x): i for i, x in enumerate(tree)}
+    return [(list(x.group_entries), x.tree_indent, x.parent_row, position.get(id(x.parent_group)),
+             [position[id(y)] for y in x.siblings]) for x in tree]
+
+
+def write_recipe(path, rows, max_indent=6, seed=0):
+    """Scan definition of boolean controls whose tree indent level follows a random walk, like automated recipes."""
+    rng = np.random.default_rng(seed)
+    indent = 0
+    with h5py.File(path, 'w') as f:
+        for i in range(rows):
+            f.create_dataset(f'scan_definition/row_{i:05d}', dtype=STRING, data=table([
+                ('device name', 'Recipe'), ('control name', f'Step {i}'), ('dimensions', 0), ('data type', 26),
+                ('tree indent level', indent), ('function', 'boolean control'), ('value', 'FALSE')]))
+            step = rng.random()
+            if step < 0.3 and indent < max_indent:
+                indent += 1
+            elif step > 0.7:
+                indent = int(rng.integers(0, indent + 1))
+        f.create_group('measurement')
+
+
+def timed(function, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(rows=10_000):
+    with tempfile.TemporaryDirectory() as directory:
+        path = pl.Path(directory) / 'recipe.h5'
+        write_recipe(path, rows)
+        with contextlib.redirect_stdout(io.StringIO()):
+            t_total, mt = timed(lambda: MeasurementTree(path, index=False, override=True, keep_file_open=True),
+                                repeat=1)
+            t_new, _ = timed(mt.build_groups)
+        t_legacy, legacy = timed(legacy_build_groups, mt.definition, repeat=1)
+        if structure(legacy) != structure(mt.new_tree):
+            raise AssertionError('build_groups differs from the previous builder')
+        mt.f.close()
+    print(f'{rows} rows, {len(mt.new_tree)} groups')
+    print(f'Tree reconstruction: {t_legacy * 1e3:.1f} ms -> {t_new * 1e3:.1f} ms ({t_legacy / t_new:.0f}x)')
+    print(f'construct_tree including the scan definition parsing: {t_total:.2f} s')
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
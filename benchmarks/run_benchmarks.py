@@ -0,0 +1,159 @@
+"""
+Benchmark suite of PyThat on synthetic measurement files (see synthetic.py).
+Every case is generated into a temporary directory. For each phase the best wall time of several runs and the peak
+memory allocated by python and numpy (tracemalloc, one additional run) are recorded. Memory allocated inside the HDF5
+and netCDF libraries is not traced.
+
+The results are compared to baselines.json. A phase is reported as regression if it is slower or needs more memory than
+tolerance times the baseline. Baselines are machine dependent, store new ones with --save after changing the machine.
+
+Usage: python benchmarks/run_benchmarks.py [--cases default large] [--save] [--tolerance 1.5] [--repeat 3]
+"""
+import contextlib
+import io
+import json
+import pathlib as pl
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from argparse import ArgumentParser
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+
+from PyThat import MeasurementTree, consolidate_dims
+from PyThat.helpers.Explorer import Explorer
+from PyThat.helpers.ROI import slice_accumulate
+from synthetic import write_synthetic
+
+BASELINES = pl.Path(__file__).with_name('baselines.json')
+# Parameters of write_synthetic
+CASES = {
+    'default': dict(loops=(20, 2, 2), indicators=((382,), (382,))),
+    'large': dict(loops=(50, 20), indicators=((1001,),) * 3),
+    'incomplete': dict(loops=(50, 20), indicators=((1001,),) * 3, completeness=0.6),
+    'deep': dict(loops=(3,) * 6, indicators=((100,),) * 2, controls_per_loop=3),
+    'metadata': dict(loops=(10, 2), indicators=((100,),) * 2, devices=20, device_rows=2000, log_rows=5000),
+}
+# Differences below are considered noise
+MIN_SECONDS = 0.005
+MIN_MB = 1.
+
+
+def measure(function, repeat: int = 3):
+    """Best wall time of repeat runs and peak traced memory of one more run.
+    :return: (dict with 'seconds' and 'peak_MB', result of the last run)
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': best, 'peak_MB': peak / 1e6}, result
+
+
+def run_case(path, repeat: int = 3) -> dict:
+    """Time the phases of the conversion and analysis of the file at path."""
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        mt = MeasurementTree(path, override=True, index=False, keep_file_open=True)
+        mt.index = True
+        results['construct_tree'], _ = measure(mt.construct_tree, repeat)
+
+        def parse_metadata():
+            mt.devices = mt.labbook = mt.logs = None
+            return mt.attrs
+        results['metadata'], _ = measure(parse_metadata, repeat)
+        results['save_netcdf'], _ = measure(mt.save_netcdf, repeat)
+        mt.f.close()
+
+        def open_netcdf():
+            opened = MeasurementTree(path)
+            opened.dataset.close()
+        results['open_netcdf'], _ = measure(open_netcdf, repeat)
+
+        dataset = mt.dataset
+        results['consolidate_dims'], _ = measure(lambda: consolidate_dims(dataset, 'Frequency'), repeat)
+
+        array = dataset[list(dataset.data_vars)[0]]
+        outer = array.dims[0]
+        edges = np.linspace(float(array[outer].min()), float(array[outer].max()), 5)
+        results['slice_accumulate'], _ = measure(lambda: slice_accumulate(array, {outer: edges}, method='mean'),
+                                                 repeat)
+
+        explorer = Explorer(array)
+        coords = array[outer].values
+        selections = [slice(coords[i], coords[-1 - i]) for i in range(min(5, len(coords) // 2))]
+
+        def explorer_update():
+            for selection in selections:
+                explorer.update({outer: selection})
+        results['explorer_update'], _ = measure(explorer_update, repeat)
+        # Time per update
+        results['explorer_update']['seconds'] /= len(selections)
+        plt.close('all')
+    return results
+
+
+def compare(results: dict, baselines: dict, tolerance: float) -> list:
+    """Print the results next to the baselines.
+    :return: List of (case, phase, quantity) which exceed tolerance times the baseline
+    """
+    regressions = []
+    print(f'{"case":12} {"phase":18} {"seconds":>10} {"baseline":>10} {"peak MB":>10} {"baseline":>10}')
+    for case, phases in results.items():
+        for phase, values in phases.items():
+            reference = baselines.get(case, {}).get(phase, {})
+            flags = []
+            for quantity, noise in [('seconds', MIN_SECONDS), ('peak_MB', MIN_MB)]:
+                base = reference.get(quantity)
+                if base is not None and values[quantity] > tolerance * base and values[quantity] - base > noise:
+                    flags.append(quantity)
+                    regressions.append((case, phase, quantity))
+            base_seconds = reference.get('seconds', float('nan'))
+            base_mb = reference.get('peak_MB', float('nan'))
+            print(f'{case:12} {phase:18} {values["seconds"]:10.4f} {base_seconds:10.4f} '
+                  f'{values["peak_MB"]:10.2f} {base_mb:10.2f}  {"REGRESSION: " + ", ".join(flags) if flags else ""}')
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark PyThat on synthetic ThatecOS files.')
+    parser.add_argument('--cases', nargs='*', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per phase')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='allowed ratio to the baseline')
+    parser.add_argument('--save', action='store_true', help='store the results as new baselines')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for case in args.cases:
+            path = pl.Path(directory) / f'{case}.h5'
+            write_synthetic(path, **CASES[case])
+            print(f'Running {case}...')
+            results[case] = run_case(path, args.repeat)
+
+    baselines = json.loads(BASELINES.read_text()) if BASELINES.exists() else {}
+    regressions = compare(results, baselines, args.tolerance)
+    if args.save:
+        baselines.update(results)
+        BASELINES.write_text(json.dumps(baselines, indent=2, sort_keys=True))
+        print(f'Saved baselines to {BASELINES}')
+    elif regressions:
+        print(f'{len(regressions)} regressions')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
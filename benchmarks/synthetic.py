@@ -0,0 +1,109 @@
+"""
+Generator of synthetic .h5 files in the layout written by ThatecOS.
+The scan definition consists of nested scalar control loops. The innermost loop contains the indicators, each with
+'measurement/*row*/data', 'scale' and 'metadata'. devices, labbook and 'measurement/log' are filled with generic
+entries of configurable size.
+
+Usage: python benchmarks/synthetic.py output.h5 [loop sizes...]
+"""
+import sys
+import h5py
+import numpy as np
+
+STRING = h5py.string_dtype()
+
+
+def table(rows):
+    """(n, 2) string dataset content from key value pairs."""
+    return np.array([[str(key), str(value)] for key, value in rows], dtype=object).reshape(-1, 2)
+
+
+def number(value):
+    return f'{value:.12E}'
+
+
+def write_synthetic(path, loops=(20, 2, 2), indicators=((382,), (382,)), completeness: float = 1.0,
+                    axis_names=('Frequency', 'Position'), dtype='float64', compression=None, device_rows: int = 100,
+                    devices: int = 4, log_rows: int = 10, controls_per_loop: int = 1, chunked: bool = True,
+                    scale_change: int or None = None, seed: int = 0):
+    """
+    Write a synthetic measurement file.
+    :param path: Path of the .h5 file
+    :param loops: Number of steps of each loop, starting with the outermost loop. The number of loops is the tree depth.
+    :param indicators: Shape of a single core measurement for each indicator in the innermost loop. () gives a scalar
+    indicator without metadata.
+    :param completeness: Fraction of the core measurements which were measured. Values < 1 give an unfinished
+    measurement.
+    :param axis_names: Names of the axes of the core measurements, further axes are called 'Axis *n*'. Indicators share
+    the names, so that the converted dimensions can be merged with consolidate_dims.
+    :param dtype: dtype of the data
+    :param compression: h5py compression of the data, e.g. 'gzip'
+    :param device_rows: Number of entries of each device
+    :param devices: Number of devices
+    :param log_rows: Number of log entries
+    :param controls_per_loop: Number of boolean controls in each loop, which are written before the scalar control.
+    :param chunked: If False, the data is stored contiguously, like finished measurements which were repacked.
+    Requires compression=None.
+    :param scale_change: Index of the first core measurement at which the increment of the first axis is doubled, like
+    after a change of the span of a spectrum analyzer. None keeps the scales constant.
+    :param seed: Seed of the random data
+    :return: Number of core measurements per indicator
+    """
+    rng = np.random.default_rng(seed)
+    total = int(np.prod(loops))
+    records = max(1, int(round(total * completeness)))
+    row = 0
+    with h5py.File(path, 'w') as f:
+        f.attrs['measurement running'] = np.uint8(completeness < 1)
+        f.attrs['thaTEC:OS version'] = 'synthetic'
+        for indent, steps in enumerate(loops):
+            for i in range(controls_per_loop):
+                f.create_dataset(f'scan_definition/row_{row:02d}', dtype=STRING, data=table([
+                    ('device name', f'Device {indent}'), ('control name', f'Switch {indent}_{i}'),
+                    ('dimensions', 0), ('data type', 26), ('tree indent level', indent),
+                    ('function', 'boolean control'), ('value', 'FALSE')]))
+                row += 1
+            f.create_dataset(f'scan_definition/row_{row:02d}', dtype=STRING, data=table([
+                ('device name', f'Device {indent}'), ('control name', f'Loop {indent} (mT)'),
+                ('dimensions', 0), ('data type', 11), ('tree indent level', indent), ('function', 'scalar control'),
+                ('start', number(-steps)), ('stop', number(steps)), ('steps', steps), ('equation', 'x')]))
+            row += 1
+        for n, shape in enumerate(indicators):
+            name = f'row_{row:02d}'
+            f.create_dataset(f'scan_definition/{name}', dtype=STRING, data=table([
+                ('device name', 'Detector'), ('control name', f'Indicator {n} (V)'), ('dimensions', len(shape)),
+                ('data type', 8), ('tree indent level', len(loops)), ('function', 'indicator')]))
+            group = f.create_group(f'measurement/{name}')
+            data = rng.random((records,) + tuple(shape)).astype(dtype)
+            chunks = (1,) + tuple(shape) if shape and chunked else None
+            group.create_dataset('data', data=data, chunks=chunks, compression=compression)
+            scale = np.tile([[-1., 0.01]] * len(shape) + [[0., 1.]], (records, 1, 1))
+            if shape and scale_change is not None:
+                scale[scale_change:, 0, 1] *= 2
+            group.create_dataset('scale', data=scale.ravel())
+            group.create_dataset('timestamp', data=np.arange(records, dtype=float))
+            if shape:
+                metadata = []
+                for axis in range(len(shape)):
+                    axis_name = axis_names[axis] if axis < len(axis_names) else f'Axis {axis}'
+                    metadata += [('name', axis_name), ('unit', 'GHz'), ('offset', number(-1)),
+                                 ('multiplier', number(0.01))]
+                metadata += [('name', f'Signal {n}'), ('unit', 'V'), ('offset', number(0)),
+                             ('multiplier', number(1))]
+                group.create_dataset('metadata', dtype=STRING, data=table(metadata))
+            row += 1
+        for d in range(devices):
+            f.create_dataset(f'devices/Device {d}', dtype=STRING, data=table(
+                [(f'Parameter%%%95%%%{i}', f'[{rng.normal():.6f}]') for i in range(device_rows)]))
+        f.create_dataset('labbook/metadata', dtype=STRING, data=table([
+            ('date', '2021-11-03'), ('operator', 'synthetic'), ('sample', f'seed {seed}')]))
+        f.create_dataset('labbook/parameter', dtype=STRING, data=table([('loops', list(loops))]))
+        f.create_dataset('labbook/comments', dtype=STRING, shape=(0, 0))
+        f.create_dataset('measurement/log', dtype=STRING, data=table(
+            [(f'2021-11-03 14:{i // 60 % 60:02d}:{i % 60:02d}', f'Step {i} completed.') for i in range(log_rows)]))
+    return records
+
+
+if __name__ == '__main__':
+    sizes = tuple(int(x) for x in sys.argv[2:]) or (20, 2, 2)
+    print(f'{write_synthetic(sys.argv[1], loops=sizes)} core measurements written to {sys.argv[1]}')
@@ -1,2 +1,3 @@
 from PyThat.h5to_nc import *
-# from h5to_nc import *
\ No newline at end of file
+from PyThat.catalog import Catalog
+# from h5to_nc import *
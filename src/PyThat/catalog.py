@@ -0,0 +1,233 @@
+import json
+import numbers
+import os
+import pathlib as pl
+import sqlite3
+import time
+import numpy as np
+from PyThat.h5to_nc import MeasurementTree
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, indexed REAL, measurement_tree TEXT,
+                                  error TEXT);
+CREATE TABLE IF NOT EXISTS entries (path TEXT, source TEXT, section TEXT, key TEXT, value TEXT, number REAL);
+CREATE TABLE IF NOT EXISTS variables (path TEXT, name TEXT, dims TEXT, shape TEXT);
+CREATE TABLE IF NOT EXISTS dims (path TEXT, name TEXT, size INTEGER);
+CREATE INDEX IF NOT EXISTS entries_key ON entries (key, source, section);
+CREATE INDEX IF NOT EXISTS entries_path ON entries (path);
+CREATE INDEX IF NOT EXISTS variables_path ON variables (path);
+CREATE INDEX IF NOT EXISTS dims_name ON dims (name, size);
+CREATE INDEX IF NOT EXISTS dims_path ON dims (path);
+"""
+# Relative tolerance of numeric comparisons in Catalog.find
+TOLERANCE = 1e-9
+
+
+def plain(value):
+    """Convert numpy scalars, arrays and bytes, e.g. of h5 attributes, to python types."""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    if isinstance(value, np.ndarray):
+        return [plain(x) for x in value.tolist()]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def flatten(source: str, metadata: dict or None, section: str = '') -> list:
+    """Rows of the entries table of a metadata dict. Nested dicts give the section, lists give one row per element.
+    :param source: 'devices', 'labbook', 'scan_definition' or 'elab'
+    :param metadata: dict of section and dict of key and value, or of key and value
+    :param section: Section of the keys of a flat dict
+    :return: List of (source, section, key, value, number)
+    """
+    rows = []
+    for key, value in (metadata or {}).items():
+        value = plain(value)
+        if isinstance(value, dict):
+            rows += flatten(source, value, str(key))
+            continue
+        for x in value if isinstance(value, list) else [value]:
+            number = float(x) if isinstance(x, numbers.Number) else None
+            rows.append((source, section, str(key), str(x), number))
+    return rows
+
+
+def extract(path) -> dict:
+    """Metadata of a .h5 file for the catalog. The file is converted in memory without reading the core measurements.
+    :return: dict with the entries, the variables with their dims and shape, the measurement tree and the error message
+    or None
+    """
+    try:
+        mt = MeasurementTree(path, index=False, quiet=True)
+    except Exception as err:
+        return {'entries': [], 'variables': [], 'measurement_tree': None, 'error': f'{type(err).__name__}: {err}'}
+    try:
+        error = None
+        variables = []
+        try:
+            dataset = mt.to_xarray(lazy=True)
+            variables = [(str(name), list(x.dims), list(x.shape)) for name, x in dataset.data_vars.items()]
+        except Exception as err:
+            error = f'{type(err).__name__}: {err}'
+        entries = (flatten('devices', mt.devices) + flatten('labbook', mt.labbook) +
+                   flatten('scan_definition', mt.definition) + flatten('elab', mt.eLab_meta))
+        return {'entries': entries, 'variables': variables, 'measurement_tree': mt.tree_string, 'error': error}
+    finally:
+        mt.close_file()
+
+
+class Catalog:
+    def __init__(self, path='catalog.sqlite'):
+        """
+        Local SQLite catalog of the metadata of measurements: devices, labbook, scan definition, eLab attributes and
+        the dimensions of the converted data. Queries only use the catalog and do not open any measurement file.
+
+        catalog = Catalog(r'D:/data/catalog.sqlite')
+        catalog.update(r'D:/data')
+        catalog.find({'section': 'Device X', 'key': 'Power (dBm)', 'value': 10})
+
+        :param path: Path of the SQLite database. It is created if it does not exist.
+        """
+        self.path = pl.Path(path).absolute()
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def update(self, root, pattern: str = '**/*.h5', workers: int or None = None, prune: bool = True) -> dict:
+        """Index the .h5 files below root which are new or were modified since they were indexed.
+        :param root: Directory which is searched
+        :param pattern: Glob pattern of the files, relative to root
+        :param workers: Number of processes which extract the metadata in parallel. None extracts one file after the
+        other. On Windows, scripts using it need an if __name__ == '__main__' guard.
+        :param prune: If True, files below root which do not exist anymore are removed from the catalog.
+        :return: dict with the lists of 'added', 'updated', 'removed' and 'failed' paths and the number of 'unchanged'
+        files
+        """
+        root = pl.Path(root).absolute()
+        rows = self.connection.execute('SELECT path, mtime, size FROM files')
+        known = {path: (mtime, size) for path, mtime, size in rows if path.startswith(str(root) + os.sep)}
+        found = {}
+        for file in root.glob(pattern):
+            if file.is_file():
+                stat = file.stat()
+                found[str(file)] = (stat.st_mtime, stat.st_size)
+        changed = sorted(x for x, state in found.items() if known.get(x) != state)
+        result = {'added': [x for x in changed if x not in known], 'updated': [x for x in changed if x in known],
+                  'removed': sorted(x for x in known if x not in found) if prune else [], 'failed': [],
+                  'unchanged': len(found) - len(changed)}
+
+        if workers:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(workers) as pool:
+                extracted = pool.map(extract, changed)
+                self.store(changed, extracted, found, result)
+        else:
+            self.store(changed, map(extract, changed), found, result)
+        with self.connection:
+            for path in result['removed']:
+                self.delete(path)
+        return result
+
+    def store(self, paths: list, extracted, found: dict, result: dict):
+        """Replace the rows of the paths by the extracted metadata. Each file is committed on its own."""
+        for path, metadata in zip(paths, extracted):
+            mtime, size = found[path]
+            with self.connection:
+                self.delete(path)
+                self.connection.execute('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                                        (path, mtime, size, time.time(), metadata['measurement_tree'],
+                                         metadata['error']))
+                self.connection.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                                            [(path,) + x for x in metadata['entries']])
+                self.connection.executemany('INSERT INTO variables VALUES (?, ?, ?, ?)',
+                                            [(path, name, json.dumps(dims), json.dumps(shape))
+                                             for name, dims, shape in metadata['variables']])
+                sizes = {dim: size for _, dims, shape in metadata['variables'] for dim, size in zip(dims, shape)}
+                self.connection.executemany('INSERT INTO dims VALUES (?, ?, ?)',
+                                            [(path, dim, size) for dim, size in sizes.items()])
+            if metadata['error']:
+                result['failed'].append(path)
+
+    def delete(self, path: str):
+        for table in ['files', 'entries', 'variables', 'dims']:
+            self.connection.execute(f'DELETE FROM {table} WHERE path = ?', (path,))
+
+    def find(self, *conditions, dims=None) -> list:
+        """Paths of the measurements which fulfil all conditions.
+        :param conditions: dicts with any of the keys
+            'source': 'devices', 'labbook', 'scan_definition' or 'elab',
+            'section': Device name, labbook group or row of the scan definition,
+            'key': Name of the parameter,
+            'value': Number, which is compared with a relative tolerance, or string, which is compared with LIKE, e.g.
+            '%Floquet%',
+            'low', 'high': Inclusive bounds of numeric values.
+        :param dims: Names of dimensions of the converted data, or dict of name and size
+        :return: Sorted list of paths
+        """
+        queries = []
+        parameters = []
+        for condition in conditions:
+            unknown = set(condition) - {'source', 'section', 'key', 'value', 'low', 'high'}
+            if unknown:
+                raise ValueError(f'Unknown fields of condition: {unknown}')
+            clauses = []
+            for field in ['source', 'section', 'key']:
+                if field in condition:
+                    clauses.append(f'{field} = ?')
+                    parameters.append(condition[field])
+            value = condition.get('value')
+            if isinstance(value, numbers.Number):
+                clauses.append('ABS(number - ?) <= ?')
+                parameters += [float(value), TOLERANCE * abs(float(value))]
+            elif value is not None:
+                clauses.append('value LIKE ?')
+                parameters.append(str(value))
+            if condition.get('low') is not None:
+                clauses.append('number >= ?')
+                parameters.append(condition['low'])
+            if condition.get('high') is not None:
+                clauses.append('number <= ?')
+                parameters.append(condition['high'])
+            queries.append('SELECT DISTINCT path FROM entries' + (' WHERE ' + ' AND '.join(clauses) if clauses else ''))
+        if dims is not None:
+            sizes = dims if isinstance(dims, dict) else dict.fromkeys(dims)
+            for name, size in sizes.items():
+                if size is None:
+                    queries.append('SELECT DISTINCT path FROM dims WHERE name = ?')
+                    parameters.append(name)
+                else:
+                    queries.append('SELECT DISTINCT path FROM dims WHERE name = ? AND size = ?')
+                    parameters += [name, size]
+        if not queries:
+            queries.append('SELECT path FROM files')
+        query = ' INTERSECT '.join(queries) + ' ORDER BY path'
+        return [x for x, in self.connection.execute(query, parameters)]
+
+    def variables(self, path) -> dict:
+        """Dimensions and shape of the data variables of an indexed measurement.
+        :return: dict of variable name and (dims, shape)
+        """
+        rows = self.connection.execute('SELECT name, dims, shape FROM variables WHERE path = ?',
+                                       (str(pl.Path(path).absolute()),))
+        return {name: (tuple(json.loads(dims)), tuple(json.loads(shape))) for name, dims, shape in rows}
+
+    def entries(self, path, source: str or None = None) -> list:
+        """(source, section, key, value) of the metadata of an indexed measurement."""
+        query = 'SELECT source, section, key, value FROM entries WHERE path = ?'
+        parameters = [str(pl.Path(path).absolute())]
+        if source is not None:
+            query += ' AND source = ?'
+            parameters.append(source)
+        return self.connection.execute(query, parameters).fetchall()
@@ -1,31 +1,142 @@
 import h5py
 import numpy as np
+import dask.array as da
 import pathlib as pl
 import textwrap
+import time
 import xarray as xr
 import json
+import hashlib
+import re
 import yaml
+import logging
+import tracemalloc
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 # import os
 # import io
 
+SPECIAL_CHARACTER = re.compile(r"%%%(\d+)%%%")
+UNITS = re.compile(r' *\((.+)\) *')
+# First characters of strings which python might parse as float: whitespace, sign, digits, '.', inf and nan
+FLOAT_START = np.array([ord(x) for x in ' \t\n\r\x0b\x0c+-.0123456789iInN'])
+# Lookup table of the ascii characters of plain decimal numbers. 0 is the padding of numpy strings.
+DECIMAL_CHARACTERS = np.zeros(128, dtype=bool)
+DECIMAL_CHARACTERS[[0] + [ord(x) for x in ' \t\n\r\x0b\x0c+-.0123456789eE']] = True
+# Tables with less rows are decoded element wise, which is faster for the short tables of the scan definition
+SMALL_TABLE = 64
+logger = logging.getLogger(__name__)
+# Json encoded run metadata. Stored in the attributes of the METADATA_GROUP of the converted file.
+METADATA_KEYS = ('devices', 'labbook', 'logs', 'measurement_tree', 'scan_definition')
+METADATA_GROUP = 'run_metadata'
+# Properties of MeasurementTree which hold the METADATA_KEYS
+METADATA_ATTRIBUTES = {'devices': 'devices', 'labbook': 'labbook', 'logs': 'logs', 'measurement_tree': 'tree_string',
+                       'scan_definition': 'definition'}
+# FilePool which shares the h5 files of all MeasurementTree objects in the process, see FilePool.__enter__
+_active_pool = None
+
 
 class MeasurementTree:
-    def __init__(self, filepath, index=True, override: bool = False, chunk=None, keep_file_open=False, mode='r'):
+    def __init__(self, filepath, index=True, override: bool = False, chunk=None, keep_file_open=False, mode='r',
+                 lazy: bool = False, stream: bool = False, buffer_size: int = 2**26, append: bool = False,
+                 encoding: str or dict or None = None, backend: str = 'netcdf', workers: int or None = None,
+                 metadata: bool = True, quiet: bool = False, trace_memory: bool = False,
+                 read_workers: int or None = None, sel: dict or None = None, isel: dict or None = None,
+                 memmap: bool = False, rdcc_nbytes: int or None = None, rdcc_nslots: int or None = None,
+                 record_scales: bool = False):
         """
         :param filepath: r-string that points to h5 file
         :param index: optional: tuple that describes group number and group internal number
         :param chunk: None will skip chunking before saving, True will set chunks to 'auto', dict will forward dict to xarray.Dataset.chunk call
         :param keep_file: If False (default), the file will be closed after conversion.
+        :param lazy: If True, the indicator data is wrapped in dask arrays and only read from the h5 file when it is
+        computed or saved. If the file is closed after conversion, the dataset is reopened from the saved netcdf.
+        :param stream: If True, the netcdf file is written by stream_netcdf. The data is copied slab by slab from the h5
+        file, so that memory usage is bounded by buffer_size. Implies lazy.
+        :param buffer_size: Maximum number of bytes per slab in stream_netcdf.
+        :param append: If True, only the core measurements which were added since the last conversion are written into
+        the existing netcdf file by update_netcdf. Falls back to a full conversion if there is no compatible file.
+        Implies lazy. The converted file is loaded into memory and closed afterwards, so that it can be updated again.
+        :param encoding: Compression and chunk layout of the netcdf variables. None writes uncompressed variables, a
+        string selects one of ENCODING_PRESETS, a dict is handled like a preset (see netcdf_encoding).
+        :param backend: 'netcdf' (default) saves a .nc file, 'zarr' saves a .zarr directory store with save_zarr.
+        :param workers: Number of threads which write the chunks of the zarr store in parallel. Defaults to the number
+        of CPUs.
+        :param metadata: If False, devices, labbook and logs are not stored in the converted file. They are only parsed
+        from the h5 file on first access of the attributes of the same name, as long as the file is open.
+        The metadata is stored in the 'run_metadata' group of the converted file and decoded on first access of the
+        attributes of the same name.
+        :param quiet: If True, the progress of the conversion is not printed. The timing of the phases is still
+        available from report() and the 'PyThat.h5to_nc' logger.
+        :param trace_memory: If True, the peak memory of each phase is traced with tracemalloc. Slows down the
+        conversion.
+        :param read_workers: Number of processes which read the data of the indicators in parallel, while the
+        measurement tree is built. Each process opens its own handle of the h5 file. None (default) reads the data one
+        indicator after the other. Ignored in lazy mode and for mode != 'r'. On Windows, scripts using it need an
+        if __name__ == '__main__' guard.
+        :param sel: Label based selection of a sub-region, e.g. {'Set Magnetic Field': slice(100, 200)}. Keys are the
+        dimension names of the converted data, values are slices, lists or single labels as for xarray.Dataset.sel.
+        Only the selected core measurements and coordinates are read from the h5 file and written. Selected dimensions
+        are kept, also for single labels. In lazy mode, the selection is read when the data is computed, with memmap
+        through the memory map. The converted file gets its own name, see netcdf_path. Not supported with stream or
+        append.
+        :param isel: Index based selection like sel, with values as for xarray.Dataset.isel.
+        :param memmap: If True, uncompressed and contiguously stored data is mapped into memory with np.memmap at its
+        offset in the h5 file instead of being read. The arrays of complete measurements are views of the file and
+        remain valid after the file is closed. Chunked or compressed data is read as usual.
+        :param rdcc_nbytes: Size of the raw data chunk cache of the h5 file in bytes. None uses the h5py default (1 MB)
+        or the setting of the active FilePool.
+        :param rdcc_nslots: Number of hash slots of the chunk cache, ideally a prime about 100 times the number of
+        chunks which fit into the cache.
+        :param record_scales: If True, the scales of all core measurements are read. Axes whose offset or increment
+        change between core measurements, e.g. by a change of the span of a spectrum analyzer, get the additional
+        coordinates '*axis*_offset' and '*axis*_increment' along the loop dimensions, with the scale of each core
+        measurement. The coordinate of the axis itself is always taken from the first core measurement. Not supported
+        with append.
         """
+        self.quiet = quiet
+        self.trace_memory = trace_memory
+        self.phases = []
+        self._phase_stack = []
         self.filepath = filepath
         self.path = pl.Path(filepath).absolute()
-        print(self.path)
-        self.f = h5py.File(self.path, mode)
-        self.definition = []
+        self.echo(self.path)
+        # Files of a FilePool are shared with other objects. They are released to the pool instead of being closed.
+        self.pool = _active_pool if mode == 'r' else None
+        self.f = open_h5(self.path, mode, rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots)
+        self._holds_file = True
+        self.metadata_path: None or pl.Path = None
+        self._run_metadata = None
+        self.definition = None
         self.tree = [[]]
         self.indent_max = 0
         self.new_tree = []
         self.chunk = chunk
+        self.lazy = lazy or stream or append
+        self.stream = stream
+        self.append = append
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        if backend not in ['netcdf', 'zarr']:
+            raise ValueError('backend must be "netcdf" or "zarr"')
+        self.backend = backend
+        self.workers = workers
+        self.store_metadata = metadata
+        self.read_workers = read_workers
+        self.memmap = memmap
+        self.sel = {} if sel is None else dict(sel)
+        self.isel = {} if isel is None else dict(isel)
+        if (self.sel or self.isel) and (stream or append):
+            raise ValueError('sel and isel are not supported with stream or append')
+        self.record_scales = record_scales
+        if record_scales and append:
+            raise ValueError('record_scales is not supported with append')
+        # Scales of the rows, see read_scales
+        self._scales = {}
+        self.indicators = {}
+        self.alignment = []
+        self.throughput = None
         self.target = None
         self.shape = None
         self.data = None
@@ -40,206 +151,579 @@ class MeasurementTree:
         self.logs = None
         self.dataset = None
         self.metadata = {}
-        self.attrs = None
         self.eLab_meta = None
 
         if not override:
             try:
-                self.open_netcdf()
+                self.open()
             except AttributeError:
                 self.construct_tree()
                 if not index:
                     return
-                self.save_netcdf()
+                self.save()
             except FileNotFoundError:
                 self.construct_tree()
                 if not index:
                     return
-                self.save_netcdf()
+                self.save()
         else:
             self.construct_tree()
             if index is False:
                 return
-            self.save_netcdf()
+            self.save()
         if not keep_file_open:
+            if self.lazy and self.indicators and self.save_path is not None and self.save_path.exists():
+                # The dask arrays still point to the h5 file. Continue with the saved file instead.
+                self.open(check=False)
+            self.close_file()
+
+    def close_file(self):
+        """Close the h5 file. A file of a FilePool is released instead and closed by the pool when it was evicted and
+        no other object uses it anymore, or when the pool is left. Calling it again has no effect."""
+        if not self._holds_file:
+            return
+        self._holds_file = False
+        if self.pool is None:
             self.f.close()
+        else:
+            self.pool.release(self.f)
 
     def list_hdf5(self):
         print(self.f.visit(print))
 
     @staticmethod
-    def save_file_from_string(obj, path):
+    def save_file_from_string(obj, path, encoding=None):
         try:
-            obj.to_netcdf(path)
+            obj.to_netcdf(path, encoding=encoding)
         except PermissionError:
-            obj.to_netcdf(str(path).encode('UTF-8'))
+            obj.to_netcdf(str(path).encode('UTF-8'), encoding=encoding)
+
+    def netcdf_path(self) -> pl.Path:
+        """Path of the netcdf file which belongs to the h5 file, the selected index and the selection of sel and isel.
+        A selection gets its own file, e.g. *name*_sel1a2b3c4d.nc, which does not replace the full conversion."""
+        name = self.path.with_suffix('').name
+        if self.index is not True:
+            name += str(self.index)
+        if self.sel or self.isel:
+            name += '_sel' + hashlib.blake2b(self.selection_string().encode(), digest_size=4).hexdigest()
+        return self.path.with_name(name + '.nc').absolute()
+
+    def selection_string(self) -> str:
+        """Text of sel and isel, which identifies the selection in the path and the fingerprint of the converted
+        file. Arrays are written completely."""
+        def plain(value):
+            return value.tolist() if isinstance(value, np.ndarray) else value
+        return repr(({k: plain(v) for k, v in self.sel.items()}, {k: plain(v) for k, v in self.isel.items()}))
+
+    def zarr_path(self) -> pl.Path:
+        """Path of the zarr store which belongs to the h5 file and the selected index."""
+        return self.netcdf_path().with_suffix('.zarr')
+
+    def open(self, check: bool = True):
+        """Open the output of a previous conversion with the selected backend."""
+        with self.phase('open', backend=self.backend):
+            if self.backend == 'zarr':
+                self.open_zarr(check)
+            else:
+                self.open_netcdf(check)
+
+    def save(self):
+        """Save the converted data with the method selected on creation of the object."""
+        with self.phase('write', backend=self.backend) as entry:
+            if self.backend == 'zarr':
+                self.save_zarr()
+            elif self.append:
+                entry['bytes_read'] = self.update_netcdf()['bytes']
+            elif self.stream:
+                entry['bytes_read'] = self.stream_netcdf()['bytes']
+            else:
+                self.save_netcdf()
+            if self.store_metadata and self._eLab_meta is None:
+                # The eLab attributes are not stored, but remain available after the h5 file has been closed
+                self.eLab_meta = self.get_elab_attrs()
+
+    def to_xarray(self, lazy: bool = True) -> xr.Dataset:
+        """Reconstruct the dataset from the h5 file without writing any file, e.g.
+        MeasurementTree(path, index=False).to_xarray(). The indicators are selected by index, or all of them if index
+        was True or False on creation. sel, isel and memmap apply as well. The metadata remains available from the
+        attributes of this object.
+        :param lazy: If True (default), the data is wrapped in dask arrays, which read from the h5 file when they are
+        computed. The h5 file stays open as long as the dataset refers to it and is closed by the close method of the
+        returned dataset. If False, all data is read into memory and the h5 file is closed, or released to its
+        FilePool, before the dataset is returned. devices, labbook, logs and eLab_meta, which are parsed from the h5 file
+        on first access, are then only available if they were accessed before.
+        :return: Dataset of the indicators, also stored in self.dataset
+        """
+        if not self._holds_file or not self.f:
+            self.close_file()
+            self.pool = _active_pool
+            self.f = open_h5(self.path, 'r')
+            self._holds_file = True
+        if self.index is False:
+            self.index = True
+        self.lazy = lazy
+        self.metadata = {}
+        self.indent_max = 0
+        try:
+            self.construct_tree()
+        finally:
+            if not lazy:
+                # All data was read, the file is not needed anymore
+                self.close_file()
+        if lazy:
+            self.dataset.set_close(self.close_file)
+        return self.dataset
+
+    def loop_dims(self) -> dict:
+        """Number of dimensions of each indicator which belong to the measurement loops, see netcdf_encoding."""
+        return {name: len(x.loop_shape) for name, x in self.indicators.items()}
+
+    def echo(self, *args, **kwargs):
+        """print, unless the object was created with quiet=True."""
+        if not self.quiet:
+            print(*args, **kwargs)
+
+    def start_phase(self, name: str, **info) -> dict:
+        """Start recording a phase of the conversion. Phases can be nested.
+        :param name: Name of the phase, e.g. 'tree', 'read' or 'write'
+        :param info: Additional fields of the entry, e.g. the indicator
+        :return: Entry of the phase. Fields like 'bytes_read' can be changed until stop_phase is called.
+        """
+        entry = {'phase': name, **info, 'parent': self._phase_stack[-1]['phase'] if self._phase_stack else None,
+                 'seconds': None, 'bytes_read': 0, 'peak_bytes': None}
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                entry['_stop_tracing'] = True
+            entry['_memory'] = tracemalloc.get_traced_memory()[0]
+            # The peak of outer phases is kept in their entries
+            for outer in self._phase_stack:
+                outer['_peak'] = max(outer.get('_peak', 0), tracemalloc.get_traced_memory()[1])
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        self._phase_stack.append(entry)
+        entry['_start'] = time.perf_counter()
+        return entry
+
+    def stop_phase(self, entry: dict):
+        """Finish a phase, append it to self.phases and log it.
+        :param entry: Entry returned by start_phase
+        """
+        entry['seconds'] = time.perf_counter() - entry.pop('_start')
+        for i, x in enumerate(self._phase_stack):
+            if x is entry:
+                del self._phase_stack[i:]
+                break
+        if '_memory' in entry:
+            peak = max(tracemalloc.get_traced_memory()[1], entry.pop('_peak', 0))
+            entry['peak_bytes'] = peak - entry.pop('_memory')
+            for outer in self._phase_stack:
+                outer['_peak'] = max(outer.get('_peak', 0), peak)
+            if entry.pop('_stop_tracing', False):
+                tracemalloc.stop()
+        self.phases.append(entry)
+        details = ', '.join(f'{key}={value}' for key, value in entry.items()
+                            if key not in ['phase', 'parent', 'seconds', 'bytes_read', 'peak_bytes'])
+        peak = '' if entry['peak_bytes'] is None else f', peak {entry["peak_bytes"] / 1e6:.1f} MB'
+        logger.info('%s%s: %.3f s, %.1f MB read%s', entry['phase'], f' ({details})' if details else '',
+                    entry['seconds'], entry['bytes_read'] / 1e6, peak, extra={'phase': entry})
+
+    @contextmanager
+    def phase(self, name: str, **info):
+        """Context manager around start_phase and stop_phase. Yields the entry of the phase."""
+        entry = self.start_phase(name, **info)
+        try:
+            yield entry
+        finally:
+            self.stop_phase(entry)
+
+    def report(self) -> dict:
+        """Timing report of the phases of the conversion, in the order in which they finished.
+        'seconds' and 'bytes_read' of the report sum up the phases which are not nested in other phases.
+        :return: dict with the path of the h5 file, the total seconds and bytes read and the list of phases. Each phase
+        has the fields 'phase', 'parent', 'seconds', 'bytes_read' and 'peak_bytes' (None without trace_memory).
+        """
+        top = [x for x in self.phases if x['parent'] is None]
+        return {'file': str(self.path),
+                'seconds': sum(x['seconds'] for x in top),
+                'bytes_read': sum(x['bytes_read'] for x in top),
+                'phases': [dict(x) for x in self.phases]}
+
+    def report_json(self, **kwargs) -> str:
+        """report() as json string. kwargs are passed to json.dumps."""
+        return json.dumps(self.report(), **kwargs)
 
     def save_netcdf(self):
         self.array: xr.DataArray
         if self.index is not True:
-            name = self.path.with_suffix('').name + str(self.index)
-            print(f'Index: {self.index}')
-            self.save_path = self.path.with_name(name).with_suffix('.nc').absolute()
-        else:
-            self.save_path = self.path.with_suffix('.nc').absolute()
+            self.echo(f'Index: {self.index}')
+        self.save_path = self.netcdf_path()
         if self.dataset is not None:
             if self.chunk is not None:
-                if isinstance(self.dataset, dict):
-                    self.dataset = self.dataset.chunk(**self.chunk)
+                if isinstance(self.chunk, dict):
+                    self.dataset = self.dataset.chunk(self.chunk)
                 elif self.chunk is True:
                     self.dataset = self.dataset.chunk(chunks='auto')
-            self.save_file_from_string(self.dataset, self.save_path)
-            print('Saved dataset as {}'.format(self.save_path))
+            encoding = None if self.encoding is None else netcdf_encoding(self.dataset, self.encoding,
+                                                                          self.loop_dims())
+            self.save_file_from_string(self.dataset, self.save_path, encoding)
+            from netCDF4 import Dataset
+            with Dataset(self.save_path, 'a') as nc:
+                self.write_run_metadata(nc)
+            self.echo('Saved dataset as {}'.format(self.save_path))
         elif self.array is not None:
             self.save_file_from_string(self.dataset, self.save_path)
-            print('Saved as {}'.format(self.save_path))
+            self.echo('Saved as {}'.format(self.save_path))
+
+    def save_zarr(self, workers: int or None = None):
+        """
+        Save the dataset to a zarr directory store. The chunks are written in parallel by a thread pool.
+        Every variable is chunked by auto_chunks, or by the chunk layout of the encoding given on creation. The zarr
+        default compressor is used.
+        :param workers: Number of threads. Defaults to the workers given on creation.
+        """
+        import dask
+        if workers is None:
+            workers = self.workers
+        self.save_path = self.zarr_path()
+        dataset = self.dataset.copy()
+        policy = {'chunks': 'auto'} if self.encoding is None else self.encoding
+        chunk_layout = netcdf_encoding(dataset, policy, self.loop_dims())
+        encoding = {}
+        for name, variable in dataset.data_vars.items():
+            chunks = chunk_layout[name].get('chunksizes')
+            if chunks is None:
+                chunks = auto_chunks(variable.shape, variable.dtype.itemsize)
+            # dask chunks have to match the zarr chunks for parallel writes
+            dataset[name] = variable.chunk(dict(zip(variable.dims, chunks)))
+            encoding[name] = {'chunks': chunks}
+        start_time = time.perf_counter()
+        delayed = dataset.to_zarr(self.save_path, mode='w', encoding=encoding, compute=False)
+        with dask.config.set(scheduler='threads', num_workers=workers):
+            delayed.compute()
+        import zarr
+        zarr.open_group(str(self.save_path), mode='a').create_group(METADATA_GROUP).attrs.update(self.run_metadata())
+        zarr.consolidate_metadata(str(self.save_path))
+        self.echo(f'Saved dataset as {self.save_path} in {time.perf_counter() - start_time:.2f} s')
+
+    def open_zarr(self, check: bool = True):
+        """Open the zarr store of a previous conversion.
+        :param check: If True, a FileNotFoundError is raised if the store was not converted from the current state of
+        the h5 file."""
+        if self.index is None or self.index is False:
+            raise FileNotFoundError
+        self.save_path = self.zarr_path()
+        if check:
+            self.check_fingerprint(self.save_path)
+        self.dataset = xr.open_zarr(self.save_path)
+        self.echo(f'Successfully loaded {self.save_path}')
+        if self.index is not True:
+            self.array = self.dataset[list(self.dataset.data_vars)[0]]
+        self.use_run_metadata(self.save_path)
+
+    def stream_netcdf(self, buffer_size: int or None = None) -> dict:
+        """Write the netcdf file directly from the h5 file without building the data in memory.
+        The variables are created from the reconstructed tree. Afterwards the core measurements of each indicator are
+        copied slab by slab from 'measurement/*row*/data'. Missing measurements remain NaN.
+        :param buffer_size: Maximum number of bytes per slab. Defaults to the buffer_size given on creation.
+        At least one core measurement is copied at a time.
+        :return: Dictionary with the number of bytes read, the elapsed time and the throughput in MB/s
+        """
+        from netCDF4 import Dataset
+        if buffer_size is None:
+            buffer_size = self.buffer_size
+        self.save_path = self.netcdf_path()
+        start_time = time.perf_counter()
+        bytes_read = 0
+        with Dataset(self.save_path, 'w') as nc:
+            # Create dimensions, coordinates and variables up front
+            encoding = {} if self.encoding is None else netcdf_encoding(
+                xr.Dataset({name: x.array for name, x in self.indicators.items()}), self.encoding, self.loop_dims())
+            for name, indicator in self.indicators.items():
+                array = indicator.array
+                for dim in array.dims:
+                    coord = array[dim]
+                    if dim in nc.dimensions:
+                        if len(nc.dimensions[dim]) != coord.size or not np.array_equal(nc[dim][:], coord.data):
+                            raise ValueError(f'The coordinates of {dim} differ between indicators. '
+                                             f'Use save_netcdf instead.')
+                        continue
+                    nc.createDimension(dim, coord.size)
+                    variable = nc.createVariable(dim, coord.dtype, (dim,), fill_value=self.fill_value(coord.dtype))
+                    variable.setncatts(coord.attrs)
+                    variable[:] = coord.data
+                variable = nc.createVariable(name, array.dtype, array.dims, fill_value=self.fill_value(array.dtype),
+                                             **encoding.get(name, {}))
+                variable.setncatts(array.attrs)
+                # Coordinates which are not dimensions, e.g. from record_scales
+                extra = [x for x in array.coords if x not in array.dims]
+                for coord_name in extra:
+                    if coord_name not in nc.variables:
+                        coord = array[coord_name]
+                        nc.createVariable(coord_name, coord.dtype, coord.dims,
+                                          fill_value=self.fill_value(coord.dtype))[:] = coord.data
+                if extra:
+                    variable.setncattr('coordinates', ' '.join(extra))
+            nc.setncatts(self.dataset.attrs)
+            self.write_run_metadata(nc)
 
-    def open_netcdf(self):
+            # Copy data slab by slab
+            for name, indicator in self.indicators.items():
+                self.echo(f'Streaming {name}: {indicator.records} core measurements')
+                bytes_read += self.copy_records(nc[name], indicator, 0, indicator.records, buffer_size)
+        self.throughput = self.report_throughput(bytes_read, time.perf_counter() - start_time)
+        self.echo('Saved dataset as {}'.format(self.save_path))
+        return self.throughput
+
+    def update_netcdf(self, buffer_size: int or None = None) -> dict:
+        """Append the core measurements which were added to the h5 file since the last conversion.
+        The number of converted core measurements is stored in the 'records' attribute of the netcdf file. Only the new
+        core measurements are read and written into the NaN padded region of the existing variables. If the file does
+        not exist or does not match the measurement tree anymore, it is rewritten by stream_netcdf.
+        :param buffer_size: Maximum number of bytes per slab. Defaults to the buffer_size given on creation.
+        :return: Dictionary with the number of bytes read, the elapsed time and the throughput in MB/s
+        """
+        from netCDF4 import Dataset
+        if buffer_size is None:
+            buffer_size = self.buffer_size
+        self.save_path = self.netcdf_path()
+        if not self.save_path.exists():
+            self.echo('No previous conversion found.')
+            return self.stream_netcdf(buffer_size)
+        start_time = time.perf_counter()
+        bytes_read = 0
+        with Dataset(self.save_path, 'a') as nc:
+            try:
+                converted = json.loads(nc.getncattr('records'))
+            except AttributeError:
+                converted = {}
+            for name, indicator in self.indicators.items():
+                if (name not in converted or name not in nc.variables
+                        or nc[name].shape != indicator.array.shape or converted[name] > indicator.records
+                        or any(not np.array_equal(nc[dim][:], indicator.array[dim].data)
+                               for dim in indicator.array.dims)):
+                    break
+            else:
+                for name, indicator in self.indicators.items():
+                    self.echo(f'Appending {name}: core measurements {converted[name]} to {indicator.records}')
+                    bytes_read += self.copy_records(nc[name], indicator, converted[name], indicator.records,
+                                                    buffer_size)
+                nc.setncatts(self.dataset.attrs)
+                self.write_run_metadata(nc)
+                self.throughput = self.report_throughput(bytes_read, time.perf_counter() - start_time)
+                self.echo('Updated dataset {}'.format(self.save_path))
+                return self.throughput
+        self.echo(f'{self.save_path} does not match the measurement tree. Converting the whole file.')
+        return self.stream_netcdf(buffer_size)
+
+    def copy_records(self, variable, indicator, start: int, stop: int, buffer_size: int) -> int:
+        """Copy the core measurements [start, stop) of an indicator slab by slab into a netcdf variable.
+        :param variable: netCDF4 variable of the indicator
+        :param indicator: Indicator which is copied
+        :param start: First core measurement
+        :param stop: End of the range (exclusive)
+        :param buffer_size: Maximum number of bytes per slab. At least one core measurement is copied at a time.
+        :return: Number of bytes read
+        """
+        source = self.f['measurement/' + indicator.row + '/data']
+        record_size = int(np.prod(source.shape[1:])) * source.dtype.itemsize
+        step = max(1, buffer_size // record_size)
+        for first in range(start, stop, step):
+            slab = source[first:min(first + step, stop)].astype(indicator.array.dtype, copy=False)
+            position = 0
+            for key in record_slabs(indicator.loop_shape, first, first + slab.shape[0]):
+                block_shape = tuple(k.stop - k.start for k in key)
+                n = int(np.prod(block_shape))
+                variable[key] = slab[position:position + n].reshape(block_shape + indicator.data_shape)
+                position += n
+        return (stop - start) * record_size
+
+    def report_throughput(self, n_bytes: int, elapsed: float) -> dict:
+        throughput = {'bytes': n_bytes, 'seconds': elapsed,
+                      'MB/s': n_bytes / 1e6 / elapsed if elapsed > 0 else float('nan')}
+        self.echo(f'Copied {n_bytes / 1e6:.1f} MB in {elapsed:.2f} s ({throughput["MB/s"]:.1f} MB/s)')
+        return throughput
+
+    @staticmethod
+    def fill_value(dtype):
+        """NaN for floating point variables, like xarray does. Other types get no fill value."""
+        return np.nan if np.issubdtype(dtype, np.floating) else None
+
+    def open_netcdf(self, check: bool = True):
         """This function opens the expected output netcdf if it exists.\n
-        Otherwise save_netcdf() is called to create such a file."""
+        Otherwise save_netcdf() is called to create such a file.
+        :param check: If True, a FileNotFoundError is raised if the netcdf file was not converted from the current state
+        of the h5 file. See source_fingerprint."""
 
+        if check and self.index is not None and self.index is not False:
+            self.check_fingerprint(self.netcdf_path())
         if self.index is True:
             try:
-                self.save_path = self.path.with_suffix('.nc').absolute()
+                self.save_path = self.netcdf_path()
                 self.dataset = xr.open_dataset(self.save_path)
-                print(f'Successfully loaded {self.save_path}')
+                self.echo(f'Successfully loaded {self.save_path}')
             except FileNotFoundError:
-                print('File not found')
+                self.echo('File not found')
                 self.save_netcdf()
                 self.dataset = xr.open_dataset(self.save_path)
-        elif self.index is None:
+        elif self.index is None or self.index is False:
+            # Without index, the measurement tree is built from the h5 file
             raise FileNotFoundError
-        elif self.index is not False:
+        else:
             try:
-                name = self.path.with_suffix('').name + str(self.index)
-                self.save_path = self.path.with_name(name).with_suffix('.nc').absolute()
+                self.save_path = self.netcdf_path()
                 self.array = xr.open_dataarray(self.save_path)
                 self.dataset = xr.open_dataarray(self.save_path)
             except FileNotFoundError:
                 self.save_netcdf()
                 self.array = xr.open_dataarray(self.save_path)
                 self.dataset = xr.open_dataarray(self.save_path)
-        try:
-            self.devices = json.loads(self.dataset.attrs['devices'])
-            self.labbook = json.loads(self.dataset.attrs['labbook'])
-            self.logs = json.loads(self.dataset.attrs['logs'])
-            self.definition = json.loads(self.dataset.attrs['scan_definition'])
-            self.tree_string = json.loads(self.dataset.attrs['measurement_tree'])
-            self.attrs = {'devices': self.devices,
-                          'labbook': self.labbook,
-                          'logs': self.logs,
-                          'measurement_tree': self.tree_string,
-                          'scan_definition': self.definition}
-        except KeyError:
-            print('Metadata not found. It will not be available.')
+        if self.append:
+            # Keep no handle of the file, so that it can be updated again while this object exists
+            for x in [self.dataset, self.array]:
+                if x is not None:
+                    x.load()
+                    x.close()
+        self.use_run_metadata(self.save_path)
 
-    def construct_tree(self):
-        self.definition = {self.check_for_sp_char(i): self.convert_to_dict(k) for (i, k) in self.f['scan_definition'].items()}
-        if 'tree_view' in self.definition.keys():
-            del(self.definition['tree_view'])
-        self.definition = self.filter_sort_rows(self.definition)
-        self.devices = {self.check_for_sp_char(i): self.convert_to_dict(k, truncate=True) for (i, k) in self.f['devices'].items()}
-        self.labbook = {self.check_for_sp_char(i): self.convert_to_dict(k) for (i, k) in self.f['labbook'].items()}
-        self.logs = self.convert_to_dict(self.f['measurement/log'])
-        self.eLab_meta = self.get_elab_attrs()
-        """
-        ////////////////////////////////////////////////////////
-        This reconstructs the multidimensional measurement tree.
-        ////////////////////////////////////////////////////////
-        """
-        # Get a list of rows names
-        rows = list(self.definition)
-        """
-        # Sort rows for indentation
-        indent_list = sorted(self.definition, key=lambda z: self.definition[z]['tree indent level'], reverse=True)
-        """
+    def use_run_metadata(self, path: pl.Path):
+        """Decode devices, labbook, logs, scan_definition and measurement_tree from the converted file at path on first
+        access. Values which are already known are kept."""
+        self.metadata_path = path
+        self._run_metadata = None
 
-        # The first step should be grouping adjacent rows with the same tree indent level
-        # Initialize the indentation
-        self.new_tree = [Group(self)]
-        previous_indent = int(self.definition[rows[0]]['tree indent level'])
-        for row, value in self.definition.items():
-            # Get indentation level of item
-            new_indent = int(value['tree indent level'])
-            # Entries with same indentation go to the same group
-            if new_indent == previous_indent:
-                self.new_tree[-1].group_entries[row] = value
-            # Entries which create a new group for new indentation
-            elif new_indent > previous_indent:
-                self.indent_max = max(self.indent_max, new_indent)
-                self.new_tree.append(Group(self))
-                self.new_tree[-1].group_entries[row] = value
-                self.new_tree[-1].tree_indent = new_indent
+    def run_metadata(self) -> dict:
+        """Json encoded metadata which is stored in the converted file. Without metadata=True only the measurement tree
+        and the scan definition are stored."""
+        keys = METADATA_KEYS if self.store_metadata else ('measurement_tree', 'scan_definition')
+        # Only the selected properties are accessed, devices, labbook and logs are parsed on access
+        return {key: json.dumps(getattr(self, METADATA_ATTRIBUTES[key])) for key in keys}
 
-                # Add next to last group as parent group
-                self.new_tree[-1].parent_group = self.new_tree[-2]
-                # Add last key of parent group as parent row
-                self.new_tree[-1].parent_row = list(self.new_tree[-2].group_entries.keys())[-1]
-            # Case of declining tree
+    def write_run_metadata(self, nc):
+        """Write the metadata into the attributes of the 'run_metadata' group of an open netCDF4 Dataset."""
+        nc.createGroup(METADATA_GROUP).setncatts(self.run_metadata())
+
+    def read_run_metadata(self, key: str):
+        """Decode one entry of the metadata of the converted file. The json strings are read once, on first access.
+        Files of earlier versions, which store the metadata in the global attributes, are read as well.
+        :param key: One of METADATA_KEYS
+        :return: Decoded value or None, if the entry was not found.
+        """
+        if self.metadata_path is None:
+            return None
+        with self.phase('metadata', group=key, source=self.metadata_path.name):
+            if self._run_metadata is None:
+                self._run_metadata = load_run_metadata(self.metadata_path)
+                if not self._run_metadata:
+                    self.echo('Metadata not found. It will not be available.')
+            try:
+                return json.loads(self._run_metadata[key])
+            except KeyError:
+                return None
+
+    def source_fingerprint(self) -> dict:
+        """Fingerprint of the h5 file, which is stored in the converted netcdf file.
+        Consists of size and modification time of the file and a hash of the HDF5 superblock and the scan_definition
+        group. The superblock contains the end of file address, which changes as soon as data is added. With sel or
+        isel, the selection is part of the fingerprint.
+        :return: dict with the keys 'size', 'mtime' and 'hash'
+        """
+        stat = self.path.stat()
+        h = hashlib.blake2b(digest_size=16)
+        with open(self.path, 'rb') as file:
+            file.seek(self.f.userblock_size)
+            h.update(file.read(256))
+        for name, dataset in sorted(self.f['scan_definition'].items()):
+            h.update(name.encode())
+            if not isinstance(dataset, h5py.Dataset):
+                continue
+            if dataset.dtype.kind == 'O':
+                for value in np.ravel(dataset[()]):
+                    h.update(value if isinstance(value, bytes) else str(value).encode())
             else:
-                self.new_tree.append(Group(self))
-                self.new_tree[-1].group_entries[row] = value
-                self.new_tree[-1].tree_indent = new_indent
+                h.update(np.ascontiguousarray(dataset[()]).tobytes())
+        fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': h.hexdigest()}
+        if self.sel or self.isel:
+            # A converted sub-region is not reused for another selection
+            fingerprint['selection'] = self.selection_string()
+        return fingerprint
 
-                # Trace back to parent
-                red_list = list(filter(lambda x: x.tree_indent < new_indent, self.new_tree))
+    def check_fingerprint(self, path: pl.Path):
+        """Raise a FileNotFoundError if the netcdf file or zarr store at path does not exist or was not converted from
+        the current state of the h5 file."""
+        if path.suffix == '.zarr':
+            import zarr
+            if not path.exists():
+                raise FileNotFoundError(path)
+            fingerprint = zarr.open_group(str(path), mode='r').attrs.get('source_fingerprint')
+        else:
+            from netCDF4 import Dataset
+            with Dataset(path, 'r') as nc:
                 try:
-                    self.new_tree[-1].parent_group = red_list[-1]
-                    self.new_tree[-1].parent_row = list(red_list[-1].group_entries.keys())[-1]
-                except IndexError:
-                    print('Expected behaviour: Last group does not have a parent.')
+                    fingerprint = nc.getncattr('source_fingerprint')
+                except AttributeError:
+                    fingerprint = None
+        if fingerprint is not None:
+            fingerprint = json.loads(fingerprint)
+        if fingerprint != self.source_fingerprint():
+            self.echo(f'{path} is outdated.')
+            raise FileNotFoundError(f'{path} was not converted from the current version of {self.path}')
 
-            previous_indent = new_indent
+    def construct_tree(self):
+        with self.phase('tree'):
+            self.definition = {self.check_for_sp_char(i): self.convert_to_dict(k)
+                               for (i, k) in self.f['scan_definition'].items()}
+            if 'tree_view' in self.definition.keys():
+                del(self.definition['tree_view'])
+            self.definition = self.filter_sort_rows(self.definition)
+            # devices, labbook, logs and eLab_meta are parsed on first access
+            """
+            ////////////////////////////////////////////////////////
+            This reconstructs the multidimensional measurement tree.
+            ////////////////////////////////////////////////////////
+            """
+            """
+            # Sort rows for indentation
+            indent_list = sorted(self.definition, key=lambda z: self.definition[z]['tree indent level'], reverse=True)
+            """
 
-        # Assemble siblings
-        # These are groups which depend on the same parent row
-        print('Number of groups: {}'.format(len(self.new_tree)))
-        # Compare tree_indent levels of all element pairs
-        for i, k in enumerate(self.new_tree):
-            # siblings.append(k)
-            for q, j in enumerate(self.new_tree[i+1:None]):
-                # If the tree_indent subverts the initial level, the two entries are not really connected
-                if j.tree_indent < k.tree_indent:
-                    break
-                # Add both entries to the siblings property.
-                if j.tree_indent == k.tree_indent:
-                    j.siblings.append(k)
-                    k.siblings.append(j)
-
-        """List Measurement Tree"""
-        print_tree_list = []
-        possible_indicators = []
-        for group, j in enumerate(self.new_tree):
-            for row, (i, k) in enumerate(j.group_entries.items()):
-                properties = ['function',
-                              'device name',
-                              'control name',
-                              'start', 'stop',
-                              'steps',
-                              'waiting period (ms)',
-                              'repetitions',
-                              'value']
-                values = []
-                printout = f'({group}, {row}) "{i}": '
-                for name in properties:
+            self.build_groups()
+            self.echo('Number of groups: {}'.format(len(self.new_tree)))
+
+            """List Measurement Tree"""
+            print_tree_list = []
+            possible_indicators = []
+            for group, j in enumerate(self.new_tree):
+                for row, (i, k) in enumerate(j.group_entries.items()):
+                    properties = ['function',
+                                  'device name',
+                                  'control name',
+                                  'start', 'stop',
+                                  'steps',
+                                  'waiting period (ms)',
+                                  'repetitions',
+                                  'value']
+                    values = []
+                    printout = f'({group}, {row}) "{i}": '
+                    for name in properties:
+                        try:
+                            values.append(k[name])
+                        except KeyError:
+                            pass
                     try:
-                        values.append(k[name])
+                        if k['function'] in ['indicator', 'internal - numeric input']:
+                            possible_indicators.append((group, row))
                     except KeyError:
                         pass
-                try:
-                    if k['function'] in ['indicator', 'internal - numeric input']:
-                        possible_indicators.append((group, row))
-                except KeyError:
-                    pass
-                printout += str(values)
-                try:
-                    printout += ' ' + str(self.get_data(i).shape)
-                except KeyError:
-                    pass
-                line = textwrap.indent(printout, ' '*2*int(j.tree_indent))
-                print_tree_list.append(line)
-                # print(line)
-        self.tree_string = '\n'.join(print_tree_list)
+                    printout += str(values)
+                    try:
+                        printout += ' ' + str(self.get_data(i).shape)
+                    except KeyError:
+                        pass
+                    line = textwrap.indent(printout, ' '*2*int(j.tree_indent))
+                    print_tree_list.append(line)
+                    # print(line)
+            self.tree_string = '\n'.join(print_tree_list)
 
         """User Input Index"""
         if self.index is None:
@@ -264,72 +748,54 @@ class MeasurementTree:
         else:
             # override possible_indicators, if index is specified
             possible_indicators = [self.index]
-            print(f'Only one index selected: {possible_indicators[0]}')
+            self.echo(f'Only one index selected: {possible_indicators[0]}')
 
+        # Start reading the data in parallel, while the coordinates are built
+        with self.prefetch_data(possible_indicators) as prefetched:
+            self.build_dataset(possible_indicators, prefetched)
+
+    def build_dataset(self, possible_indicators: list, prefetched: dict):
+        """Build the coordinates and the dataset of the selected indicators, see construct_tree.
+        :param possible_indicators: (group, row) indices of the indicators
+        :param prefetched: Futures of the data which is read in parallel, see prefetch_data
+        """
         # create array with all core-data names
         # create self.metadata
-        core_data_names = []
-        for (i, k) in self.f['scan_definition'].items():
-            meta_entry = self.get_metadata(i)
-            if meta_entry is not None:
-                try:
-                    name_entry = meta_entry['name']
-                    if isinstance(name_entry, list):
-                        name = [self.avoid_duplicate(i, core_data_names) for i in name_entry]
-                        meta_entry['name'] = name
-                        core_data_names = core_data_names + name
-                    elif isinstance(name_entry, str):
-                        name = self.avoid_duplicate(name_entry, core_data_names)
-                        core_data_names.append(name)
-                        meta_entry['name'] = name
-                except KeyError:
-                    pass
-            self.metadata[i] = meta_entry
-        print(f'Core data names: {core_data_names}')
-
-        # print()
-        # print('Core Data Metadata:')
-        # for i, j in self.metadata.items():
-        #     if j is not None:
-        #         print(i)
-        #         for k in j.values():
-        #             print(k)
-
-        # Check control names in self.definition for duplicate and rename
-        # control_keys: list of already encountered keys
-        control_keys = core_data_names
-        for v, u in self.definition.items():
-            key_control_name = None
-            try:
-                key_control_name = u['control name']
-            except KeyError:
-                if u['function'] == 'internal - repetitions':
-                    key_control_name = 'repetitions'
-            # if key_control_name was not yet encountered, add to list of encountered keys
-            # only if control key is either control name or repetitions
-            if key_control_name is not None:
-                key_control_name, unit = self.get_units(key_control_name)
-                if key_control_name in control_keys:
-                    key_control_name = self.avoid_duplicate(key_control_name, control_keys)
-                u['control name'] = key_control_name
-                control_keys.append(key_control_name)
-                u['units'] = unit
-            # print(u)
-        # print([u['units'] for u in self.definition.values() if 'units' in u])
+        with self.phase('core_metadata'):
+            for i in self.f['scan_definition']:
+                self.metadata[i] = self.get_metadata(i)
+            core_data_names = self.rename_core_data(self.metadata)
+            self.echo(f'Core data names: {core_data_names}')
+            self.rename_controls(self.definition, core_data_names)
 
         all_indicators = []
+        self.indicators = {}
         for x in possible_indicators:
             # self.index = x
             group, row = x
             # self.index = x
             self.target: Group = self.new_tree[group]
 
+            phase = self.start_phase('read', index=x)
             try:
                 self.data = self.target.get_data(row)
             except KeyError:
-                print(f'Data for {x} could not be found.')
+                self.echo(f'Data for {x} could not be found.')
+                self.stop_phase(phase)
                 continue
+            mapped = memory_map(self.data) if self.memmap else None
+            if mapped is not None:
+                # Pages are only read on access
+                self.data = mapped
+                phase['memmap'] = True
+            elif x in prefetched:
+                self.data = prefetched[x].result()
+            if not self.lazy and mapped is None:
+                phase['bytes_read'] = self.data.size * self.data.dtype.itemsize
+            if self.lazy and mapped is None:
+                self.data = self.lazy_data(self.data)
             data_shape = tuple(list(self.data.shape)[1:])
+            flattened_length_data = self.data.shape[0]
             parent: Group = self.target.parent_group
             parent_row = self.target.parent_row
 
@@ -342,10 +808,11 @@ class MeasurementTree:
                     self.indicator_name = self.definition[global_row]['name']
                 else:
                     raise KeyError(f'Error while trying to fetch the name for an numeric input in {global_row}')
-            print()
-            print("Building xarray object for:")
-            print(f"{self.indicator_name}, {global_row}")
-            print("________________________________________________________")
+            self.echo()
+            self.echo("Building xarray object for:")
+            self.echo(f"{self.indicator_name}, {global_row}")
+            phase['indicator'] = self.indicator_name
+            self.echo("________________________________________________________")
 
             """
             Go through all parents and add control names to dimension names.
@@ -364,7 +831,7 @@ class MeasurementTree:
                 try:
                     unit = self.definition[parent_row]["units"]
                 except KeyError:
-                    print(f'No Unit found for {control_name}, {parent_row}')
+                    self.echo(f'No Unit found for {control_name}, {parent_row}')
                 """check if unit has already been stored"""
 
                 # Get units from paranthesis in control name
@@ -381,13 +848,13 @@ class MeasurementTree:
                     # Add control name as key to the coords dict. Assign data to that key.
                 except KeyError as err:
                     if self.definition[parent_row]['function'] == 'internal - repetitions':
-                        print('Repetitions. Generating incrementing as coords.')
+                        self.echo('Repetitions. Generating incrementing as coords.')
                         rep = int(self.definition[parent_row]['repetitions'])
                         roi = [rep]
                         shape.append(rep)
                         row_data = np.arange(rep)
                     elif self.definition[parent_row]['function'] == 'scalar control':
-                        print(f'Scalar control {control_name} without data. Generating coords.')
+                        self.echo(f'Scalar control {control_name} without data. Generating coords.')
                         if isinstance(self.definition[parent_row]['start'], list):
                             part = []
                             roi = []
@@ -425,18 +892,24 @@ class MeasurementTree:
 
             # iterate over metadata to innermost data to get names of all dimensions
             metadata = self.metadata[self.target[row][0]]
+            # (offset, increment) of each core measurement, for axes whose scales change between core measurements
+            record_scales = {}
             if metadata is not None:
-                print(f'Get Metadata for: {self.target[row][0]}')
+                self.echo(f'Get Metadata for: {self.target[row][0]}')
                 for i in range(len(data_shape)):
                     coord_name = metadata['name'][i]
                     scales = self.get_scales(self.target[row][0], i)
                     coords[coord_name] = scales
+                    if self.record_scales:
+                        specs = self.get_record_scales(self.target[row][0], i)
+                        if specs is not None:
+                            record_scales[coord_name] = specs
                     dims.append(coord_name)
                     segments.append([len(scales)])
                     unit = metadata['unit'][i]
                     units.append(unit)
             else:
-                print(f'No Metadata found for {self.indicator_name}')
+                self.echo(f'No Metadata found for {self.indicator_name}')
                 coord_name = 'some_dimension'
                 for i, dat_shape in enumerate(data_shape):
                     coord_name = self.avoid_duplicate(coord_name, coords.keys())
@@ -448,54 +921,280 @@ class MeasurementTree:
             dims = tuple(dims)
             shape.reverse()
             self.shape = tuple(shape)+data_shape
-            try:
-                # TODO: Is there a way to reshape using dask?
-                self.data = np.reshape(self.data, self.shape)
-                print(f'Desired shape: {self.shape}, data shape: {self.data.shape}, size: {self.data.size}')
-            except ValueError:
+            if self.sel or self.isel:
+                positions = self.selection_positions(dims, coords)
+                for i, (dim, position) in enumerate(zip(dims, positions)):
+                    if position is not None:
+                        coords[dim] = take(coords[dim], position)
+                        segments[i] = [len(position)]
+                # Unfinished measurements are NaN padded floats, like without selection
+                fill = np.nan if flattened_length_data < np.prod(shape) else None
+                # Mapped data is read through the memory map
+                source = self.target.get_data(row) if mapped is None else mapped
+                if self.lazy and mapped is None:
+                    # The selection is read as a single chunk when the data is computed
+                    import dask
+                    selected_shape = tuple(n if p is None else len(p) for p, n in zip(positions, self.shape))
+                    read = dask.delayed(self.read_hyperslab, pure=False)(source, positions, tuple(shape),
+                                                                         flattened_length_data, fill)
+                    self.data = da.from_delayed(read[0], selected_shape,
+                                                dtype=source.dtype if fill is None else np.float64)
+                else:
+                    self.data, phase['bytes_read'] = self.read_hyperslab(source, positions, tuple(shape),
+                                                                         flattened_length_data, fill)
+                self.echo(f'Selected shape: {self.data.shape} of {self.shape}')
+                self.shape = self.data.shape
+                self.stop_phase(phase)
+            elif flattened_length_data < np.prod(shape):
+                # The measurement is padded before its data is accessed, so that a h5 dataset is read only once,
+                # directly into the padded array
+                unread = isinstance(self.data, h5py.Dataset)
+                if unread:
+                    phase['bytes_read'] = 0
+                self.stop_phase(phase)
                 # TODO: Find a way to drop empty slices
-                print('Measurement not finished?')
-                print(f'Desired shape: {self.shape}, data shape: {self.data.shape}, size: {self.data.size}')
+                self.echo('Measurement not finished?')
+                self.echo(f'Desired shape: {self.shape}, data shape: {self.data.shape}, size: {self.data.size}')
                 flattened_length = np.prod(shape)
-                flattened_length_data = self.data.shape[0]
-                if not flattened_length_data == int(self.data.size/np.prod(data_shape)):
-                    raise ValueError('The dimensions extracted from the measurement tree dont add up')
-                print(f'Number of core measurements: {flattened_length_data} of {flattened_length}')
+                self.echo(f'Number of core measurements: {flattened_length_data} of {flattened_length}')
                 flattened_shape = (flattened_length,)+data_shape
-                print(f'flattened shape: {flattened_shape}')
-                # initialize flattened with nan
-                flattened_new = np.empty(flattened_shape)
-                flattened_new[...] = np.nan
-                # write existing, override nans with existing data
-                flattened_new[0:flattened_length_data, ...] = self.data
+                self.echo(f'flattened shape: {flattened_shape}')
+                phase = self.start_phase('pad', index=x, indicator=phase['indicator'])
+                if unread:
+                    phase['bytes_read'] = self.data.size * self.data.dtype.itemsize
+                self.data = self.pad_data(self.data, flattened_shape)
                 # bring data to correct shape
-                self.data = np.reshape(flattened_new, self.shape)
+                self.data = self.data.reshape(self.shape)
+                self.stop_phase(phase)
+            else:
+                try:
+                    if self.lazy:
+                        self.data = self.data.reshape(self.shape)
+                    else:
+                        self.data = np.reshape(self.data, self.shape)
+                except ValueError:
+                    raise ValueError('The dimensions extracted from the measurement tree dont add up')
+                self.echo(f'Desired shape: {self.shape}, data shape: {self.data.shape}, size: {self.data.size}')
+                self.stop_phase(phase)
 
+            for name, specs in record_scales.items():
+                self.echo(f'Scales of {name} change between core measurements.')
+                specs = self.pad_data(specs, (int(np.prod(shape)), 2)).reshape(tuple(shape) + (2,))
+                if self.sel or self.isel:
+                    specs = specs[np.ix_(*[np.arange(n) if p is None else p for n, p in zip(shape, positions)])]
+                # No spaces, which would turn them into data variables in the netcdf file
+                coords[name + '_offset'] = (dims[:len(shape)], specs[..., 0])
+                coords[name + '_increment'] = (dims[:len(shape)], specs[..., 1])
 
-            print()
+            self.echo()
             self.array = xr.DataArray(self.data, dims=dims, coords=coords, name=self.indicator_name)
             # Add units to Attributes
-            for x, y, z in zip(dims, units, segments):
-                self.array[x].attrs['units'] = y
-                self.array[x].attrs['segments'] = z
+            for dim, unit, segment in zip(dims, units, segments):
+                self.array[dim].attrs['units'] = unit
+                self.array[dim].attrs['segments'] = segment
             self.array.attrs['units'] = indicator_unit
             all_indicators.append(self.array)
-            print(f'Segments: {segments}')
+            self.indicators[self.indicator_name] = Indicator(global_row, x, tuple(shape), data_shape, self.array,
+                                                             flattened_length_data)
+            self.echo(f'Segments: {segments}')
 
-        self.dataset = xr.combine_by_coords(all_indicators)
+        unknown = [x for x in list(self.sel) + list(self.isel) if not any(x in y.dims for y in all_indicators)]
+        if unknown:
+            raise ValueError(f'{unknown} are not dimensions of the converted data')
+        with self.phase('combine') as phase:
+            self.dataset = self.assemble_dataset(all_indicators)
+            phase['aligned'] = bool(self.alignment)
 
-        # add metadata to xarray attrs
-        try:
-            self.attrs = {'devices': self.devices,
-                          'labbook': self.labbook,
-                          'logs': self.logs,
-                          'measurement_tree': self.tree_string,
-                          'scan_definition': self.definition}
-        except NameError:
-            print('Metadata has not been initialized.')
+        # devices, labbook, logs, measurement_tree and scan_definition are written to the run_metadata group on save
         from json import dumps
-        for attr, val in self.attrs.items():
-            self.dataset.attrs[attr] = dumps(val)
+        # Number of converted core measurements for update_netcdf
+        self.dataset.attrs['records'] = dumps({name: x.records for name, x in self.indicators.items()})
+        self.dataset.attrs['source_fingerprint'] = dumps(self.source_fingerprint())
+
+    def build_groups(self):
+        """Group adjacent rows of self.definition with the same tree indent level into self.new_tree and link every group
+        to its parent group and row in a single pass."""
+        # Initialize the indentation
+        self.new_tree = [Group(self)]
+        # Groups with increasing tree_indent. After removing all groups with tree_indent >= new_indent, the last one is
+        # the last group of lower indentation, i.e. the parent of a new group.
+        stack = [self.new_tree[0]]
+        # Runs of groups with the same tree_indent, which are not separated by a group of lower indentation
+        runs = {0: [self.new_tree[0]]}
+        self.new_tree[0].sibling_run = runs[0]
+        previous_indent = int(self.definition[next(iter(self.definition))]['tree indent level'])
+        for row, value in self.definition.items():
+            # Get indentation level of item
+            new_indent = int(value['tree indent level'])
+            # Entries with same indentation go to the same group
+            if new_indent == previous_indent:
+                self.new_tree[-1].add(row, value)
+                previous_indent = new_indent
+                continue
+            # Entries which create a new group for new indentation
+            if new_indent > previous_indent:
+                self.indent_max = max(self.indent_max, new_indent)
+            group = Group(self)
+            group.add(row, value)
+            group.tree_indent = new_indent
+            while stack and stack[-1].tree_indent >= new_indent:
+                stack.pop()
+            if stack:
+                # Add last key of parent group as parent row
+                group.parent_group = stack[-1]
+                group.parent_row = stack[-1].rows[-1]
+            else:
+                self.echo('Expected behaviour: Last group does not have a parent.')
+            stack.append(group)
+            self.new_tree.append(group)
+
+            # Assemble siblings
+            # These are groups which depend on the same parent row. A group of lower indentation ends the runs of all
+            # deeper groups.
+            for indent in [x for x in runs if x > new_indent]:
+                del runs[indent]
+            group.sibling_run = runs.setdefault(new_indent, [])
+            group.sibling_run.append(group)
+            previous_indent = new_indent
+
+    def assemble_dataset(self, arrays: list) -> xr.Dataset:
+        """Build the dataset from the DataArrays of the indicators.
+        If coordinates of the same name have equal values and attributes in all indicators, the dataset is created
+        directly from the variables and the indicators share the coordinate objects. Otherwise the indicators are
+        aligned by xr.combine_by_coords, which fills the missing values with NaN in a copy of the data. The reasons are
+        stored in self.alignment, printed and logged as warning.
+        :param arrays: DataArrays of the indicators
+        :return: Dataset of all indicators
+        """
+        coords = {}
+        self.alignment = []
+        for array in arrays:
+            for name, coord in array.coords.items():
+                if name not in coords:
+                    coords[name] = coord.variable
+                    continue
+                shared = coords[name]
+                if shared.shape != coord.shape:
+                    reason = f'{coord.size} instead of {shared.size} values'
+                elif not np.array_equal(shared.values, coord.values):
+                    reason = 'different values'
+                # repr, because nan segments are not equal to themselves
+                elif repr(shared.attrs) != repr(coord.attrs):
+                    reason = 'different attributes'
+                else:
+                    continue
+                self.alignment.append({'indicator': array.name, 'coordinate': name, 'reason': reason,
+                                       'materialized_bytes': 0})
+        if not self.alignment:
+            return xr.Dataset({array.name: array.variable for array in arrays}, coords=coords)
+
+        dataset = xr.combine_by_coords(arrays)
+        for array in arrays:
+            if dataset[array.name].shape != array.shape:
+                entries = [x for x in self.alignment if x['indicator'] == array.name]
+                if not entries:
+                    entries = [{'indicator': array.name, 'coordinate': None,
+                                'reason': 'coordinates extended by other indicators'}]
+                    self.alignment += entries
+                for entry in entries:
+                    entry['materialized_bytes'] = dataset[array.name].nbytes
+        for entry in self.alignment:
+            message = (f'Alignment of {entry["indicator"]} along {entry["coordinate"]}: {entry["reason"]}, '
+                       f'{entry["materialized_bytes"] / 1e6:.1f} MB materialized')
+            self.echo(message)
+            logger.warning(message)
+        return dataset
+
+    @property
+    def attrs(self) -> dict:
+        """Metadata of the measurement, which is stored in the converted file. Entries which are not available are
+        omitted."""
+        attrs = {'devices': self.devices,
+                 'labbook': self.labbook,
+                 'logs': self.logs,
+                 'measurement_tree': self.tree_string,
+                 'scan_definition': self.definition}
+        return {key: value for key, value in attrs.items() if value is not None}
+
+    @property
+    def definition(self) -> dict or None:
+        """Rows of the scan definition. Read from the converted file on first access after opening it."""
+        if self._definition is None:
+            self._definition = self.read_run_metadata('scan_definition')
+        return self._definition
+
+    @definition.setter
+    def definition(self, value):
+        self._definition = value
+
+    @property
+    def tree_string(self) -> str or None:
+        """Printout of the measurement tree. Read from the converted file on first access after opening it."""
+        if self._tree_string is None:
+            self._tree_string = self.read_run_metadata('measurement_tree')
+        return self._tree_string
+
+    @tree_string.setter
+    def tree_string(self, value):
+        self._tree_string = value
+
+    @property
+    def devices(self) -> dict or None:
+        """Devices configuration at the beginning of the measurement. Read from the converted file or parsed from the
+        h5 file on first access."""
+        if self._devices is None:
+            self._devices = self.read_run_metadata('devices')
+        if self._devices is None and self.f:
+            with self.phase('metadata', group='devices'):
+                self._devices = {self.check_for_sp_char(i): self.convert_to_dict(k, truncate=True)
+                                 for (i, k) in self.f['devices'].items()}
+        return self._devices
+
+    @devices.setter
+    def devices(self, value):
+        self._devices = value
+
+    @property
+    def labbook(self) -> dict or None:
+        """Labbook entries as specified in the Thatec interface. Read from the converted file or parsed from the h5
+        file on first access."""
+        if self._labbook is None:
+            self._labbook = self.read_run_metadata('labbook')
+        if self._labbook is None and self.f:
+            with self.phase('metadata', group='labbook'):
+                self._labbook = {self.check_for_sp_char(i): self.convert_to_dict(k)
+                                 for (i, k) in self.f['labbook'].items()}
+        return self._labbook
+
+    @labbook.setter
+    def labbook(self, value):
+        self._labbook = value
+
+    @property
+    def logs(self) -> dict or None:
+        """Log entries which occurred during the measurement. Read from the converted file or parsed from the h5 file
+        on first access."""
+        if self._logs is None:
+            self._logs = self.read_run_metadata('logs')
+        if self._logs is None and self.f:
+            with self.phase('metadata', group='logs'):
+                self._logs = self.convert_to_dict(self.f['measurement/log'])
+        return self._logs
+
+    @logs.setter
+    def logs(self, value):
+        self._logs = value
+
+    @property
+    def eLab_meta(self) -> dict or None:
+        """Attributes of the eLab group. Parsed on first access."""
+        if self._eLab_meta is None and self.f:
+            self._eLab_meta = self.get_elab_attrs()
+        return self._eLab_meta
+
+    @eLab_meta.setter
+    def eLab_meta(self, value):
+        self._eLab_meta = value
 
     def print_metadata(self, metadata):
         """
@@ -516,10 +1215,8 @@ class MeasurementTree:
 
     @staticmethod
     def get_units(control_name):
-        from re import compile, search
-        find_units = compile(r' *\((.+)\) *')
         try:
-            g = find_units.search(control_name)
+            g = UNITS.search(control_name)
             unit = g.group(1)
             rem = g.group(0)
             control_name = control_name.replace(rem, "").rstrip()
@@ -527,22 +1224,60 @@ class MeasurementTree:
         except AttributeError:
             return control_name, ''
 
+    def read_scales(self, row: str) -> np.ndarray:
+        """Offset and increment of the axes of the core measurements of a row, cached per row.
+        Only the first core measurement is read, unless the object was created with record_scales=True.
+        :param row: Name of the row
+        :return: Array of shape (core measurements, dimensions + 1, 2)
+        :raises KeyError: If the row has no scales
+        :raises ValueError: If the number of scales does not fit the data
+        """
+        records = self.data.shape[0]
+        if (row, records) not in self._scales:
+            scale = self.f['measurement/' + row + '/scale']
+            per_record = (int(self.definition[row]['dimensions']) + 1) * 2
+            if scale.size != records * per_record:
+                raise ValueError(f'{scale.size} scales for {records} core measurements of {row}')
+            if self.record_scales or not scale.size:
+                values = scale[()]
+            else:
+                # Leading entries along the first axis which hold the scales of the first core measurement, also if
+                # the scales are stored with one row per core measurement
+                row_size = scale.size // scale.shape[0]
+                values = np.ravel(scale[:-(-per_record // row_size)])[:per_record]
+            self._scales[(row, records)] = np.asarray(values).reshape(-1, per_record // 2, 2)
+        return self._scales[(row, records)]
+
     def get_scales(self, row: str, index: int) -> np.ndarray or None:
-        scale_shape = (self.data.shape[0], (int(self.definition[row]['dimensions'])+1), 2)
         data_shape = self.data.shape[1:][index]
         try:
-            scale_specs = np.array(self.f['measurement/' + row + '/scale']).reshape(scale_shape)[0, index, :]
+            scale_specs = self.read_scales(row)[0, index, :]
             # stop = data_shape*scale_specs[1] + scale_specs[0]
             # scales = np.linspace(scale_specs[0], stop, data_shape)
             scales = np.arange(data_shape)*scale_specs[1]+scale_specs[0]
             return scales
         except KeyError:
-            print('No scales found.')
+            self.echo('No scales found.')
             return None
         except ValueError:
-            print('Scales do not fit the required dimensions.')
+            self.echo('Scales do not fit the required dimensions.')
             return np.arange(data_shape)
 
+    def get_record_scales(self, row: str, index: int) -> np.ndarray or None:
+        """Offset and increment of an axis for each core measurement, if they change between core measurements.
+        :param row: Name of the row
+        :param index: Index of the axis
+        :return: Array of shape (core measurements, 2), or None if all core measurements have the scales of the first one
+        or there are no scales
+        """
+        try:
+            specs = self.read_scales(row)[:, index, :]
+        except (KeyError, ValueError):
+            return None
+        if len(specs) < 2 or np.array_equal(specs, np.broadcast_to(specs[0], specs.shape)):
+            return None
+        return specs
+
     def get_data(self, row: str):
         """
         :param row: Name of the row
@@ -550,27 +1285,192 @@ class MeasurementTree:
         """
         return self.f['measurement/' + row + '/data']
 
-    def get_metadata(self, row: str, truncate: bool = False) -> np.ndarray or None:
+    @contextmanager
+    def prefetch_data(self, indices: list):
+        """Read the data of the indicators in a process pool of read_workers processes, while the context is active.
+        Each worker opens the h5 file itself, as h5py does not allow concurrent reads from one file handle. On exit,
+        e.g. after an error, reads which have not started yet are cancelled and the running ones are waited for, so
+        that no worker is left reading the file.
+        :param indices: (group, row) indices of the indicators
+        :return: Yields a dict of index and concurrent.futures.Future of the data as numpy array. Empty if read_workers
+        is not set, in lazy mode, with a selection or if the file is not opened read only.
+        """
+        if not self.read_workers or self.lazy or self.f.mode != 'r' or self.sel or self.isel:
+            yield {}
+            return
+        from concurrent.futures import ProcessPoolExecutor
+        prefetched = {}
+        pool = ProcessPoolExecutor(max_workers=self.read_workers)
         try:
-            obj = self.f['measurement/' + row + '/metadata'].asstr()[:, :]
-            metadata = {}
-            for x in obj:
-                metadata[x[0]] = []
-            for x in obj:
-                test_string = x[1][1:-1] if truncate else x[1]
+            for index in indices:
                 try:
-                    z = float(test_string)
-                except ValueError:
-                    if test_string == 'false':
-                        z = False
-                    elif test_string == 'true':
-                        z = True
-                    else:
-                        z = test_string
-                metadata[x[0]].append(z)
-            return metadata
-        except KeyError:
-            return None
+                    row = self.new_tree[index[0]][index[1]][0]
+                except (IndexError, TypeError):
+                    continue
+                if 'measurement/' + row + '/data' in self.f:
+                    if self.memmap and memory_map(self.f['measurement/' + row + '/data']) is not None:
+                        continue
+                    prefetched[index] = pool.submit(read_records, self.path, row)
+            yield prefetched
+        finally:
+            for future in prefetched.values():
+                future.cancel()
+            pool.shutdown(wait=True)
+
+    def selection_positions(self, dims: tuple, coords: dict) -> list:
+        """Integer positions of sel and isel along each dimension of an indicator.
+        isel is applied first, sel is applied to the labels which remain.
+        :param dims: Dimensions of the indicator
+        :param coords: Coordinates of the dimensions, numpy arrays or h5 datasets
+        :return: List with an array of positions or None (no selection) per dimension
+        """
+        positions = []
+        for dim in dims:
+            if dim not in self.sel and dim not in self.isel:
+                positions.append(None)
+                continue
+            index = np.arange(len(coords[dim]))
+            if dim in self.isel:
+                index = np.atleast_1d(index[self.isel[dim]])
+            if dim in self.sel:
+                labels = take(coords[dim], index)
+                index = np.atleast_1d(xr.DataArray(index, dims=dim, coords={dim: labels}).sel({dim: self.sel[dim]}).values)
+            positions.append(index)
+        return positions
+
+    @staticmethod
+    def read_hyperslab(source: h5py.Dataset, positions: list, loop_shape: tuple, records: int, fill=None) -> tuple:
+        """Read the selected core measurements of an indicator with HDF5 hyperslab selections.
+        The selected positions of the loops are converted to core measurement numbers. Each contiguous range of them is
+        read with one hyperslab. Contiguous selections of the core measurement axes are part of the hyperslab, other
+        selections read the enclosing range.
+        :param source: Dataset of 'measurement/*row*/data'
+        :param positions: Positions per dimension of the loops and the core measurement, None for all
+        :param loop_shape: Shape of the parent loops
+        :param records: Number of core measurements found in the file
+        :param fill: Value of core measurements which were not measured yet. None if all selected ones exist.
+        :return: (array of the selected shape, number of bytes read)
+        """
+        n_loops = len(loop_shape)
+        positions = [np.arange(n) if p is None else p for p, n in zip(positions, loop_shape + source.shape[1:])]
+        inner_key, inner_take = [], []
+        for p in positions[n_loops:]:
+            step = p[1] - p[0] if len(p) > 1 else 1
+            if len(p) and step > 0 and np.all(np.diff(p) == step):
+                inner_key.append(slice(p[0], p[-1] + 1, step))
+                inner_take.append(None)
+            else:
+                inner_key.append(slice(p.min(), p.max() + 1) if len(p) else slice(0, 0))
+                inner_take.append(p - p.min() if len(p) else p)
+        selected_shape = tuple(len(p) for p in positions)
+        # Core measurement number of every selected combination of loop positions
+        numbers = np.ravel_multi_index(np.ix_(*positions[:n_loops]), loop_shape).ravel() if n_loops else np.zeros(1, int)
+        out_shape = (len(numbers),) + selected_shape[n_loops:]
+        if fill is None:
+            out = np.empty(out_shape, dtype=source.dtype)
+        else:
+            out = np.full(out_shape, fill, dtype=np.float64)
+        available = np.flatnonzero(numbers < records)
+        order = available[np.argsort(numbers[available], kind='stable')]
+        values = numbers[order]
+        bytes_read = 0
+        for run in np.split(np.arange(len(values)), np.flatnonzero(np.diff(values) != 1) + 1):
+            if not len(run):
+                continue
+            block = source[(slice(values[run[0]], values[run[-1]] + 1),) + tuple(inner_key)]
+            bytes_read += block.nbytes
+            for axis, index in enumerate(inner_take):
+                if index is not None:
+                    block = np.take(block, index, axis=axis + 1)
+            out[order[run]] = block
+        return out.reshape(selected_shape), bytes_read
+
+    @staticmethod
+    def pad_data(data, flattened_shape):
+        """Fill the missing core measurements of an unfinished measurement with NaN.
+        Dask arrays are concatenated with a lazy NaN remainder, so memory only scales with the chunk size. h5 datasets
+        are read directly into the NaN initialized array without an intermediate copy.
+        :param data: h5 dataset, numpy array or dask array with the measured core measurements along the first axis
+        :param flattened_shape: Shape of the planned measurement with all loops flattened into the first axis
+        :return: Array of flattened_shape
+        """
+        missing = flattened_shape[0] - data.shape[0]
+        if isinstance(data, da.Array):
+            remainder = da.full((missing,) + tuple(flattened_shape[1:]), np.nan,
+                                chunks=(data.chunksize[0],) + tuple(flattened_shape[1:]))
+            return da.concatenate([data.astype(np.float64), remainder])
+        # initialize flattened with nan
+        flattened_new = np.full(flattened_shape, np.nan)
+        # write existing, override nans with existing data
+        if isinstance(data, h5py.Dataset):
+            data.read_direct(flattened_new, dest_sel=np.s_[0:data.shape[0], ...])
+        else:
+            flattened_new[0:data.shape[0], ...] = data
+        return flattened_new
+
+    @staticmethod
+    def lazy_data(dataset: h5py.Dataset, chunks='auto') -> da.Array:
+        """Wrap a h5 dataset in a dask array without reading it.
+        :param dataset: Dataset of 'measurement/*row*/data'
+        :param chunks: Chunk size along the first axis (core measurements). The remaining axes are not split, so that
+        the array can be reshaped to the tree shape without rechunking the inner data.
+        :return: dask array backed by the h5 dataset
+        """
+        chunks = {0: chunks, **{i: -1 for i in range(1, dataset.ndim)}}
+        return da.from_array(dataset, chunks=chunks, lock=True)
+
+    def get_metadata(self, row: str, truncate: bool = False) -> dict or None:
+        return read_core_metadata(self.f, row, truncate)
+
+    @staticmethod
+    def rename_core_data(metadata: dict) -> list:
+        """Make the names of the axes of the core measurements unique across all rows, in place.
+        :param metadata: dict of row and metadata of its core measurements (see get_metadata) or None
+        :return: List of all names
+        """
+        core_data_names = []
+        for meta_entry in metadata.values():
+            if meta_entry is not None:
+                try:
+                    name_entry = meta_entry['name']
+                    if isinstance(name_entry, list):
+                        name = [MeasurementTree.avoid_duplicate(i, core_data_names) for i in name_entry]
+                        meta_entry['name'] = name
+                        core_data_names = core_data_names + name
+                    elif isinstance(name_entry, str):
+                        name = MeasurementTree.avoid_duplicate(name_entry, core_data_names)
+                        core_data_names.append(name)
+                        meta_entry['name'] = name
+                except KeyError:
+                    pass
+        return core_data_names
+
+    @staticmethod
+    def rename_controls(definition: dict, core_data_names: list):
+        """Remove the units from the control names of a scan definition and make them unique, in place. The units are
+        stored in the 'units' entry of the rows.
+        :param definition: Scan definition, e.g. from filter_sort_rows
+        :param core_data_names: Names of the axes of the core measurements, see rename_core_data
+        """
+        # Check control names in the definition for duplicate and rename
+        # control_keys: set of already encountered keys
+        control_keys = set(core_data_names)
+        for v, u in definition.items():
+            key_control_name = None
+            try:
+                key_control_name = u['control name']
+            except KeyError:
+                if u['function'] == 'internal - repetitions':
+                    key_control_name = 'repetitions'
+            # if key_control_name was not yet encountered, add to list of encountered keys
+            # only if control key is either control name or repetitions
+            if key_control_name is not None:
+                key_control_name, unit = MeasurementTree.get_units(key_control_name)
+                if key_control_name in control_keys:
+                    key_control_name = MeasurementTree.avoid_duplicate(key_control_name, control_keys)
+                u['control name'] = key_control_name
+                control_keys.add(key_control_name)
+                u['units'] = unit
 
     def get_elab_attrs(self, group: str = 'eLab') -> dict:
         group_dict = {}
@@ -582,18 +1482,15 @@ class MeasurementTree:
                 except KeyError:
                     pass
         except KeyError:
-            print('The eLab Group could not be found in the hdf5 file.')
+            self.echo('The eLab Group could not be found in the hdf5 file.')
         return group_dict
 
     @staticmethod
     def check_for_sp_char(text):
-        import re
-        special_char = re.compile(r"%%%(\d+)%%%")
         text = str(text)
-        res = special_char.finditer(text)
-        for v in res:
-            text = text.replace(v.group(), chr(int(v.group(1))))
-        return text
+        if '%%%' not in text:
+            return text
+        return SPECIAL_CHARACTER.sub(lambda v: chr(int(v.group(1))), text)
 
     @staticmethod
     def convert_to_dict(obj: h5py.Dataset, truncate=False):
@@ -606,19 +1503,11 @@ class MeasurementTree:
             return {}
         """Problem: In den Thatec Daten gibt es teils metadaten in denen die gleichen Keys mehrmals vorkommen.
         Dies führt dazu, dass diese überschrieben werden."""
+        keys, values = decode_table(obj.asstr()[:, :], truncate=truncate)
+        if len(set(keys)) == len(keys):
+            return dict(zip(keys, values))
         a = {}
-        for i, x in enumerate(obj.asstr()[:, :]):
-            test_string = x[1][1:-1] if truncate else x[1]
-            try:
-                z = float(test_string)
-            except ValueError:
-                if test_string == 'false':
-                    z = False
-                elif test_string == 'true':
-                    z = True
-                else:
-                    z = MeasurementTree.check_for_sp_char(test_string)
-            key = MeasurementTree.check_for_sp_char(x[0])
+        for key, z in zip(keys, values):
             try:
                 # Check if entry exists
                 q = a[key]
@@ -646,36 +1535,542 @@ class MeasurementTree:
         return {k: definition[k] for k in [k for k, _ in sorted(sorting.items(), key=lambda item: item[1])]}
 
 class Group:
+    __slots__ = ('parent_group', 'parent_row', 'tree_indent', 'group_entries', 'rows', 'sibling_run', 'max_indent',
+                 'm_tree')
+
     def __init__(self, m_tree: MeasurementTree):
         self.parent_group: Group or None = None
         self.parent_row = None
         self.tree_indent = 0
         self.group_entries: dict = {}
-        self.siblings = []
+        # Row names in the order of group_entries, for indexed access
+        self.rows: list = []
+        self.sibling_run: list = [self]
         self.max_indent = 0
         self.m_tree = m_tree
 
+    def add(self, row: str, value: dict):
+        """Add a row of the scan definition to the group."""
+        self.group_entries[row] = value
+        self.rows.append(row)
+
+    @property
+    def siblings(self) -> list:
+        """Groups with the same tree_indent, which are not separated from this group by a group of lower indentation."""
+        return [x for x in self.sibling_run if x is not self]
+
     def __getitem__(self, index: int):
-        return list(self.group_entries.items())[index]
+        row = self.rows[index]
+        return row, self.group_entries[row]
 
     def get_data(self, index: int = -1):
         """Get data of indexed entry of that group.
         :param index: Specified index in that group. Last index by default.
         :return: The data set of 'measurement/*row*/data' of the specified index"""
-        row = list(self.group_entries.keys())[index]
-        return self.m_tree.f['measurement/' + row + '/data']
+        return self.m_tree.f['measurement/' + self.rows[index] + '/data']
 
     def __repr__(self):
         return str(self.group_entries.keys())
 
 
 class Row:
+    __slots__ = ('group', 'parent', 'name')
+
     def __init__(self):
         self.group = None
         self.parent = None
         self.name: str or None = None
 
 
+class Indicator:
+    def __init__(self, row: str, index: tuple, loop_shape: tuple, data_shape: tuple, array: xr.DataArray,
+                 records: int):
+        """Layout of a converted indicator.
+        :param row: Name of the row in 'measurement'
+        :param index: (group, row) index in the measurement tree
+        :param loop_shape: Shape of the parent loops. The core measurements are stored flattened along this shape.
+        :param data_shape: Shape of a single core measurement
+        :param array: DataArray of the indicator
+        :param records: Number of core measurements found in the h5 file
+        """
+        self.row = row
+        self.index = index
+        self.loop_shape = loop_shape
+        self.data_shape = data_shape
+        self.array = array
+        self.records = records
+
+    def __repr__(self):
+        return f'{self.array.name}: {self.row} {self.loop_shape}+{self.data_shape}'
+
+
+class FilePool:
+    def __init__(self, max_open: int = 16, rdcc_nbytes: int or None = None, rdcc_nslots: int or None = None):
+        """Pool of h5 files, which are opened read only and shared by all MeasurementTree objects of the process while
+        the pool is active:
+
+        with FilePool(max_open=32, rdcc_nbytes=2**26):
+            ...
+
+        Repeatedly opening the same file reuses the open handle and its warm chunk cache. Each MeasurementTree holds
+        its file until MeasurementTree.close_file is called, e.g. by closing a lazy dataset of to_xarray. If more than
+        max_open files are kept, the least recently used one is evicted: it is closed at once if nobody holds it, or
+        else as soon as the last holder releases it. All files are closed when the pool is left, also the held ones.
+        :param max_open: Maximum number of files kept open
+        :param rdcc_nbytes: Size of the raw data chunk cache of each file in bytes, None for the h5py default
+        :param rdcc_nslots: Number of hash slots of the chunk cache, None for the h5py default
+        """
+        self.max_open = max_open
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+        self.files = OrderedDict()
+        # Number of holders of each open file by id, including evicted files which are still held
+        self.users = {}
+        self.evicted = {}
+        self.hits = 0
+        self.misses = 0
+        self._previous = None
+        self._lock = threading.Lock()
+
+    def open(self, path, rdcc_nbytes: int or None = None, rdcc_nslots: int or None = None) -> h5py.File:
+        """Open file of the pool. The chunk cache settings default to the ones of the pool and only apply if the file
+        is not open yet."""
+        path = pl.Path(path).absolute()
+        with self._lock:
+            file = self.files.get(path)
+            # Files can be closed outside of the pool, e.g. by MeasurementTree.f.close()
+            if file:
+                self.files.move_to_end(path)
+                self.hits += 1
+                self.users[id(file)] += 1
+                return file
+            self.misses += 1
+            if file is not None:
+                self.users.pop(id(file), None)
+            file = h5py.File(path, 'r', **chunk_cache(rdcc_nbytes or self.rdcc_nbytes, rdcc_nslots or self.rdcc_nslots))
+            self.files[path] = file
+            self.users[id(file)] = 1
+            while len(self.files) > self.max_open:
+                _, old = self.files.popitem(last=False)
+                if self.users[id(old)]:
+                    self.evicted[id(old)] = old
+                else:
+                    del self.users[id(old)]
+                    old.close()
+            return file
+
+    def release(self, file: h5py.File):
+        """Release a file returned by open. Evicted files are closed when they are released by their last holder."""
+        with self._lock:
+            if id(file) not in self.users:
+                return
+            self.users[id(file)] -= 1
+            if not self.users[id(file)] and id(file) in self.evicted:
+                del self.users[id(file)]
+                self.evicted.pop(id(file)).close()
+
+    def close(self):
+        """Close all files of the pool, including evicted files which are still held."""
+        with self._lock:
+            for file in list(self.files.values()) + list(self.evicted.values()):
+                file.close()
+            self.files.clear()
+            self.evicted.clear()
+            self.users.clear()
+
+    def __enter__(self):
+        """Activate the pool for the MeasurementTree objects of the process."""
+        global _active_pool
+        self._previous, _active_pool = _active_pool, self
+        return self
+
+    def __exit__(self, *args):
+        global _active_pool
+        _active_pool = self._previous
+        self.close()
+
+    def __repr__(self):
+        return f'FilePool({len(self.files)}/{self.max_open} open, {self.hits} hits, {self.misses} misses)'
+
+
+def load_run_metadata(path: pl.Path) -> dict:
+    """Json strings of the metadata of a converted .nc file or .zarr store, see MeasurementTree.read_run_metadata.
+    :return: dict of the entries of METADATA_KEYS which were found
+    """
+    if path.suffix == '.zarr':
+        import zarr
+        root = zarr.open_group(str(path), mode='r')
+        attrs = root[METADATA_GROUP].attrs if METADATA_GROUP in root.group_keys() else root.attrs
+        return {k: attrs[k] for k in METADATA_KEYS if k in attrs}
+    from netCDF4 import Dataset
+    with Dataset(path, 'r') as nc:
+        group = nc.groups.get(METADATA_GROUP, nc)
+        return {k: group.getncattr(k) for k in METADATA_KEYS if k in group.ncattrs()}
+
+
+def read_scan_definition(path) -> dict:
+    """Scan definition of a .h5 file or of a converted .nc file or .zarr store, without reading any data. The control
+    names of .h5 files are made unique and their units are split off like in MeasurementTree.construct_tree, so that
+    both give the same definition.
+    :return: dict of row name and row entries, ordered by row number
+    """
+    path = pl.Path(path).absolute()
+    if path.suffix in ['.nc', '.zarr']:
+        definition = json.loads(load_run_metadata(path).get('scan_definition', 'null'))
+        if definition is None:
+            raise ValueError(f'{path} does not contain a scan definition')
+        return definition
+    with h5py.File(path, 'r') as f:
+        definition = {MeasurementTree.check_for_sp_char(name): MeasurementTree.convert_to_dict(table)
+                      for name, table in f['scan_definition'].items()}
+        metadata = {row: read_core_metadata(f, row) for row in f['scan_definition']}
+    # Renamed like in MeasurementTree.construct_tree, which gives the definition stored in converted files
+    definition = MeasurementTree.filter_sort_rows(definition)
+    MeasurementTree.rename_controls(definition, MeasurementTree.rename_core_data(metadata))
+    return definition
+
+
+def read_core_metadata(f: h5py.File, row: str, truncate: bool = False) -> dict or None:
+    """Metadata of the core measurements of a row, e.g. the names and units of their axes.
+    :return: dict of key and list of values, or None if the row has no metadata
+    """
+    try:
+        obj = f['measurement/' + row + '/metadata']
+    except KeyError:
+        return None
+    keys, values = decode_table(obj.asstr()[:, :], truncate=truncate, special_characters=False)
+    metadata = {}
+    for key, value in zip(keys, values):
+        metadata.setdefault(key, []).append(value)
+    return metadata
+
+
+def tree_signature(definition: dict, ignore=()) -> list:
+    """Entries of a scan definition which determine the dimensions of the converted data: tree indent level,
+    function, control name without units, number of indicator dimensions and steps or repetitions of each row.
+    :param definition: Scan definition, e.g. from read_scan_definition
+    :param ignore: Control names whose steps are not compared, e.g. the dimension along which files are concatenated
+    """
+    signature = []
+    for entry in definition.values():
+        name, _ = MeasurementTree.get_units(str(entry.get('control name', entry.get('name', ''))))
+        steps = None if name in ignore else entry.get('steps', entry.get('repetitions'))
+        signature.append((int(entry['tree indent level']), entry.get('function'), name, entry.get('dimensions'), steps))
+    return signature
+
+
+def open_campaign(paths, concat_dim: str = 'file', labels=None, workers: int or None = None, join: str = 'exact',
+                  **kwargs) -> xr.Dataset:
+    """Open many measurements as one lazily concatenated dataset, e.g. a field series split into several files.
+    The measurement trees are compared via their scan definitions before any data is opened. Converted files (.nc,
+    .zarr) are opened with dask chunks, .h5 files are converted in memory with MeasurementTree.to_xarray, without
+    writing a file. Only the chunks used by a computation are read.
+    :param paths: Paths of .h5, .nc or .zarr files, in the order of concatenation
+    :param concat_dim: Name of the dimension along which the files are concatenated. If it is a dimension of the
+    measurements, e.g. a loop which was split into several files, the files are concatenated along it and its steps
+    may differ between the files. Otherwise a new dimension is created.
+    :param labels: Coordinate of a new concat_dim, e.g. the temperatures of the files. Defaults to the file names.
+    :param workers: Number of threads which open the files in parallel. None uses the default of ThreadPoolExecutor.
+    :param join: How differing coordinates of the other dimensions are handled, see xarray.concat. 'exact' (default)
+    raises an error instead of filling missing values with NaN.
+    :param kwargs: Further arguments of MeasurementTree for .h5 files, e.g. index or sel
+    :return: Concatenated dataset. Attributes which differ between the files are dropped. Its close method closes all
+    files.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    paths = [pl.Path(x).absolute() for x in paths]
+    if not paths:
+        raise ValueError('No files given')
+    with ThreadPoolExecutor(workers) as pool:
+        definitions = list(pool.map(read_scan_definition, paths))
+    reference = tree_signature(definitions[0], ignore=[concat_dim])
+    for path, definition in zip(paths[1:], definitions[1:]):
+        signature = tree_signature(definition, ignore=[concat_dim])
+        if signature != reference:
+            differences = [x for x in zip(reference, signature) if x[0] != x[1]] or [(len(reference), len(signature))]
+            raise ValueError(f'The measurement tree of {path} differs from {paths[0]}: {differences[0]}')
+
+    kwargs.setdefault('quiet', True)
+    # Applied by to_xarray, the tree is only built on creation
+    index = kwargs.pop('index', True)
+
+    def open_file(path):
+        if path.suffix == '.zarr':
+            return xr.open_zarr(path)
+        if path.suffix == '.nc':
+            return xr.open_dataset(path, chunks={})
+        mt = MeasurementTree(path, index=False, **kwargs)
+        mt.index = index
+        return mt.to_xarray(lazy=True)
+
+    with ThreadPoolExecutor(workers) as pool:
+        datasets = list(pool.map(open_file, paths))
+    if concat_dim not in datasets[0].dims:
+        labels = [x.name for x in paths] if labels is None else list(labels)
+        concat_dim = xr.DataArray(labels, dims=concat_dim, name=concat_dim)
+    campaign = xr.concat(datasets, dim=concat_dim, coords='minimal', compat='override', join=join,
+                         combine_attrs='drop_conflicts')
+
+    def close():
+        for dataset in datasets:
+            dataset.close()
+    # The files stay open until the concatenated dataset is closed
+    campaign.set_close(close)
+    return campaign
+
+
+def chunk_cache(rdcc_nbytes: int or None = None, rdcc_nslots: int or None = None) -> dict:
+    """Keyword arguments of h5py.File for the given chunk cache settings. None keeps the default."""
+    settings = {'rdcc_nbytes': rdcc_nbytes, 'rdcc_nslots': rdcc_nslots}
+    return {key: value for key, value in settings.items() if value is not None}
+
+
+def open_h5(path, mode: str = 'r', rdcc_nbytes: int or None = None, rdcc_nslots: int or None = None) -> h5py.File:
+    """Open a h5 file. Read only files are taken from the active FilePool, if there is one."""
+    if _active_pool is not None and mode == 'r':
+        return _active_pool.open(path, rdcc_nbytes, rdcc_nslots)
+    return h5py.File(path, mode, **chunk_cache(rdcc_nbytes, rdcc_nslots))
+
+
+def take(values, index: np.ndarray) -> np.ndarray:
+    """values[index] for numpy arrays and h5 datasets. Contiguous positions of h5 datasets are read as hyperslab."""
+    if isinstance(values, h5py.Dataset):
+        if len(index) and np.all(np.diff(index) == 1):
+            return values[index[0]:index[-1] + 1]
+        values = values[()]
+    return np.asarray(values)[index]
+
+
+def memory_map(dataset: h5py.Dataset) -> np.memmap or None:
+    """Map a dataset into memory at its offset in the file, without reading it.
+    :param dataset: h5 dataset
+    :return: Read only np.memmap of the dataset, or None if the dataset is chunked, compressed, stored externally, of
+    variable length type or not yet allocated
+    """
+    if dataset.chunks is not None or dataset.external is not None or dataset.dtype.hasobject or dataset.size == 0:
+        return None
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+    return np.memmap(dataset.file.filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+
+
+def read_records(path: pl.Path, row: str) -> np.ndarray:
+    """Read 'measurement/*row*/data' with a separate handle of the h5 file. Used by the worker processes of
+    MeasurementTree.prefetch_data."""
+    with h5py.File(path, 'r') as f:
+        return f['measurement/' + row + '/data'][()]
+
+
+def record_slabs(loop_shape: tuple, start: int, stop: int):
+    """Split the core measurements [start, stop) of the flattened loops into hyperslabs of loop_shape.
+    :param loop_shape: Shape of the parent loops
+    :param start: First core measurement
+    :param stop: End of the range (exclusive)
+    :return: Generator of tuples of slices, following the order of the core measurements
+    """
+    if start >= stop:
+        return
+    if not loop_shape:
+        yield ()
+        return
+    inner = int(np.prod(loop_shape[1:]))
+    first, head = divmod(start, inner)
+    last, tail = divmod(stop, inner)
+    if head:
+        # partially filled first slice
+        end = min(stop, (first + 1) * inner)
+        for key in record_slabs(loop_shape[1:], head, end - first * inner):
+            yield (slice(first, first + 1),) + key
+        if end == stop:
+            return
+        first += 1
+    if last > first:
+        yield (slice(first, last),) + tuple(slice(0, n) for n in loop_shape[1:])
+    if tail:
+        for key in record_slabs(loop_shape[1:], 0, tail):
+            yield (slice(last, last + 1),) + key
+
+
+def decode_table(table, truncate: bool = False, special_characters: bool = True) -> (list, list):
+    """
+    Decode a key value table as saved by thatec os, one column at a time.
+    Values are converted to float if possible, 'true' and 'false' to bool. Everything else remains a string.
+    :param table: Array of strings with shape (n, 2), e.g. dataset.asstr()[:, :]
+    :param truncate: bool, defines if the first and last character of each value ('[]') will be cut
+    :param special_characters: bool, defines if '%%%NN%%%' escapes in keys and string values are decoded
+    :return: list of keys and list of decoded values
+    """
+    if len(table) < SMALL_TABLE:
+        keys, values = [], []
+        for x in table:
+            test_string = x[1][1:-1] if truncate else x[1]
+            try:
+                z = float(test_string)
+            except ValueError:
+                if test_string == 'false':
+                    z = False
+                elif test_string == 'true':
+                    z = True
+                else:
+                    z = MeasurementTree.check_for_sp_char(test_string) if special_characters else test_string
+            keys.append(MeasurementTree.check_for_sp_char(x[0]) if special_characters else x[0])
+            values.append(z)
+        return keys, values
+    table = np.asarray(table, dtype=str)
+    keys, values = table[:, 0], table[:, 1]
+    length = values.dtype.itemsize // 4
+    if truncate and length > 0:
+        # Work on the code points: drop the first character and the last character of each string
+        chars = np.ascontiguousarray(values).view(np.uint32).reshape(len(values), length)[:, 1:].copy()
+        end = np.char.str_len(values) - 2
+        chars[np.nonzero(end >= 0)[0], end[end >= 0]] = 0
+        values = chars.view(f'<U{max(length - 1, 1)}').reshape(-1) if length > 1 else np.full(len(values), '')
+
+    result = values.astype(object)
+    is_number = np.zeros(len(values), dtype=bool)
+    # Only strings starting with one of FLOAT_START or a non-ascii character can be numbers
+    first = np.ascontiguousarray(values).view(np.uint32).reshape(len(values), -1)[:, 0]
+    candidates = np.nonzero(np.isin(first, FLOAT_START) | (first > 127))[0]
+    # Plain decimal numbers are converted in bulk, everything else (inf, nan, unicode digits, ...) one by one
+    chars = np.ascontiguousarray(values[candidates]).view(np.uint32).reshape(len(candidates),
+                                                                             values.dtype.itemsize // 4)
+    decimal = np.where(chars < 128, DECIMAL_CHARACTERS[np.minimum(chars, 127)], False).all(axis=1)
+    single = candidates[~decimal]
+    try:
+        result[candidates[decimal]] = values[candidates[decimal]].astype(np.float64).astype(object)
+        is_number[candidates[decimal]] = True
+    except ValueError:
+        single = candidates
+    # Each distinct string is only parsed once
+    unique, inverse = np.unique(values[single], return_inverse=True)
+    parsed = np.full(len(unique), None, dtype=object)
+    for i, text in enumerate(unique.tolist()):
+        try:
+            parsed[i] = float(text)
+        except ValueError:
+            pass
+    numbers = np.not_equal(parsed[inverse], None)
+    result[single[numbers]] = parsed[inverse][numbers]
+    is_number[single[numbers]] = True
+    result[~is_number & (values == 'false')] = False
+    result[~is_number & (values == 'true')] = True
+    if special_characters:
+        escaped = np.nonzero(~is_number & (np.char.find(values, '%%%') >= 0))[0]
+        result[escaped] = decode_special_characters(values[escaped])
+        escaped = np.nonzero(np.char.find(keys, '%%%') >= 0)[0]
+        keys = keys.astype(object)
+        keys[escaped] = decode_special_characters(keys[escaped])
+    return keys.tolist(), result.tolist()
+
+
+def decode_special_characters(strings: np.ndarray) -> list:
+    """Decode the '%%%NN%%%' escapes of an array of strings. Each string is decoded on its own, as the escapes can
+    encode any character, e.g. '\x00'."""
+    def decode(v):
+        return chr(int(v.group(1)))
+    return [SPECIAL_CHARACTER.sub(decode, x) for x in strings.tolist()]
+
+
+ENCODING_PRESETS = {
+    # Light compression for a fast conversion
+    'fast': {'zlib': True, 'complevel': 1, 'shuffle': True, 'chunks': 'auto'},
+    # Strong compression for long term storage
+    'archive': {'zlib': True, 'complevel': 9, 'shuffle': True, 'chunks': 'auto'},
+    # Chunks which span two loop dimensions, the first one and the largest other one, so that the 2D views of the
+    # Explorer read few chunks. The axes of the core measurements are split first, then the other loop dimensions.
+    'explorer': {'zlib': True, 'complevel': 4, 'shuffle': True, 'chunks': 'explorer'},
+}
+
+
+def auto_chunks(shape: tuple, itemsize: int, target_bytes: int = 2**20, keep: tuple = (),
+                split_first: tuple = ()) -> tuple:
+    """
+    Chunk shape with at most target_bytes per chunk.
+    The largest chunk dimension is halved until the chunk is small enough. Dimensions in split_first are split before
+    all others, dimensions in keep are only split if all other dimensions have been reduced to 1.
+    :param shape: Shape of the variable
+    :param itemsize: Number of bytes per element
+    :param target_bytes: Maximum number of bytes per chunk
+    :param keep: Indices of dimensions which should not be split
+    :param split_first: Indices of dimensions which are split first
+    :return: Tuple of chunk sizes
+    """
+    chunks = [max(1, int(x)) for x in shape]
+    others = [i for i in range(len(chunks)) if i not in keep and i not in split_first]
+    while int(np.prod(chunks)) * itemsize > target_bytes:
+        candidates = []
+        for group in [split_first, others, keep]:
+            candidates = [i for i in group if chunks[i] > 1]
+            if candidates:
+                break
+        if not candidates:
+            break
+        i = max(candidates, key=lambda j: chunks[j])
+        chunks[i] = -(-chunks[i] // 2)
+    return tuple(chunks)
+
+
+def explorer_chunk_dims(shape: tuple, loops: int) -> tuple:
+    """
+    Dimensions which are kept whole and split first by the 'explorer' chunk policy.
+    :param shape: Shape of the variable
+    :param loops: Number of leading dimensions which belong to the measurement loops, the others are the axes of the
+    core measurements
+    :return: (keep, split_first) indices for auto_chunks. keep holds the first loop dimension, which is part of every
+    view of the Explorer with cuts='minimal', and the largest other loop dimension.
+    """
+    loops = min(loops, len(shape))
+    keep = (0,) if loops else ()
+    if loops > 1:
+        keep += (max(range(1, loops), key=lambda i: shape[i]),)
+    return keep, tuple(range(loops, len(shape)))
+
+
+def netcdf_encoding(dataset: xr.Dataset, policy: str or dict, loops: dict or None = None) -> dict:
+    """
+    Create the encoding argument of xarray.Dataset.to_netcdf for all data variables.
+    :param dataset: Dataset which will be saved
+    :param policy: Name of a preset in ENCODING_PRESETS or dict with the keys
+    'zlib' (bool), 'complevel' (0-9), 'shuffle' (bool),
+    'chunks' ('auto', 'explorer', None or dict of dimension name and chunk size),
+    'target_chunk_bytes' (int, used by 'auto' and 'explorer', default 1 MiB),
+    'preset' (name of a preset which is used for all keys that are not given) and
+    'variables' (dict of variable name and encoding, which overrides the generated encoding of that variable).
+    :param loops: dict of variable name and number of leading dimensions which belong to the measurement loops, used by
+    'explorer'. Variables which are missing are treated as loops only.
+    :return: dict of variable name and encoding
+    """
+    if isinstance(policy, str):
+        policy = {'preset': policy}
+    options = {'zlib': False, 'complevel': 4, 'shuffle': False, 'chunks': None, 'target_chunk_bytes': 2**20}
+    if 'preset' in policy:
+        options.update(ENCODING_PRESETS[policy['preset']])
+    options.update({k: v for k, v in policy.items() if k not in ['preset', 'variables']})
+    encoding = {}
+    for name, variable in dataset.data_vars.items():
+        enc = {}
+        if options['zlib']:
+            enc.update(zlib=True, complevel=int(options['complevel']))
+        if options['shuffle']:
+            enc['shuffle'] = True
+        chunks = options['chunks']
+        if variable.ndim > 0 and chunks is not None:
+            if isinstance(chunks, dict):
+                enc['chunksizes'] = tuple(min(int(chunks.get(dim, n)), n) for dim, n in variable.sizes.items())
+            else:
+                keep, split_first = (), ()
+                if chunks == 'explorer':
+                    keep, split_first = explorer_chunk_dims(variable.shape, (loops or {}).get(name, variable.ndim))
+                enc['chunksizes'] = auto_chunks(variable.shape, variable.dtype.itemsize,
+                                                options['target_chunk_bytes'], keep, split_first)
+        encoding[name] = enc
+    for name, enc in policy.get('variables', {}).items():
+        if name in encoding:
+            encoding[name] = {**encoding[name], **enc}
+    return encoding
+
+
 def consolidate_dims(array, name_includes, compare_to: str or None = None, new_dim: str = None):
     """
     This function helps finding unnecessary duplicates of dimensions.
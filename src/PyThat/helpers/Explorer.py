@@ -2,7 +2,9 @@ import matplotlib.gridspec
 from matplotlib.widgets import RectangleSelector
 import numpy as np
 import matplotlib.pyplot as plt
-from itertools import combinations
+from itertools import combinations, product
+import json
+import pathlib as pl
 from matplotlib.widgets import Button
 from matplotlib.widgets import CheckButtons
 from matplotlib.colors import LogNorm
@@ -15,13 +17,27 @@ from xarray import Dataset
 from xarray import broadcast
 from xarray import merge
 import xarray as xr
+from collections import OrderedDict
 
 def load_record(path='ROI.sl'):
     with open(path, 'rb') as f:
         regions = load(f)
         return regions
 
-def reduce_ds(ds, hyper_slice, remaining_dims):
+def reduce_ds(ds, hyper_slice, remaining_dims, cache=None, index=None):
+    """
+    Mean of ds over the hyper_slice of all dimensions except remaining_dims.
+    :param cache: Optional ReductionCache, which returns previously computed means of the same selection
+    :param index: Optional PrefixSumIndex of ds, which computes the mean with a fixed number of lookups
+    """
+    if cache is not None:
+        return cache.reduce(ds, hyper_slice, remaining_dims, index)
+    if index is not None:
+        try:
+            red_slice = {x: value for x, value in hyper_slice.items() if x not in remaining_dims}
+            return index.mean(ds, slice_positions(ds, red_slice))
+        except (KeyError, TypeError, ValueError):
+            pass
     red_slice = hyper_slice.copy()
     for i in remaining_dims:
         del (red_slice[i])
@@ -33,11 +49,206 @@ def reduce_ds(ds, hyper_slice, remaining_dims):
     da = ds.mean(list(red_slice.keys()))
     return da
 
+def slice_positions(ds, red_slice):
+    """
+    Integer positions selected by red_slice, like ds.sel for coordinates and ds.isel for other dimensions.
+    :raises KeyError, TypeError, ValueError: If the selection can not be expressed as positions, e.g. for an index which
+    is not monotonic.
+    """
+    positions = {}
+    for x, value in red_slice.items():
+        if x not in ds.indexes:
+            positions[x] = value
+        elif isinstance(value, slice):
+            start, stop = [v.values[()] if isinstance(v, DataArray) else v for v in (value.start, value.stop)]
+            positions[x] = ds.indexes[x].slice_indexer(start, stop, value.step)
+        else:
+            raise TypeError(f'Selection of {x} is not a slice')
+    return positions
+
+
+class PrefixSumIndex:
+    def __init__(self, data, tables=None):
+        """
+        Summed-area tables of a DataArray or of the variables of a Dataset. The sum and the number of values which are
+        not NaN over any box are obtained from 2**k entries of the tables, with k the number of reduced dimensions, so
+        the mean over a selection does not depend on its size. Needs twice the memory of the data as float64.
+        :param data: DataArray or Dataset
+        :param tables: Tables of load(), instead of computing them
+        """
+        variables = {data.name: data} if isinstance(data, DataArray) else dict(data.data_vars)
+        self.dims = {name: tuple(x.dims) for name, x in variables.items()}
+        self.shapes = {name: tuple(x.shape) for name, x in variables.items()}
+        if tables is None:
+            tables = {name: self.build(x.values) for name, x in variables.items()}
+        self.tables = tables
+
+    @staticmethod
+    def build(values):
+        """
+        Cumulative sums along all axes of the values and of the number of values which are not NaN, with a leading
+        row of zeros along each axis.
+        :return: (sums, counts)
+        """
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        inner = (slice(1, None),) * values.ndim
+        sums = np.zeros(tuple(n + 1 for n in values.shape))
+        sums[inner] = np.where(valid, values, 0)
+        counts = np.zeros(sums.shape, dtype=np.int64)
+        counts[inner] = valid
+        for axis in range(values.ndim):
+            np.cumsum(sums, axis=axis, out=sums)
+            np.cumsum(counts, axis=axis, out=counts)
+        return sums, counts
+
+    @staticmethod
+    def box(table, bounds):
+        """
+        Sum over the box bounds of the original values, for all positions of the other axes.
+        :param table: Summed-area table
+        :param bounds: dict of axis and (start, stop) position
+        """
+        axes = list(bounds)
+        total = 0
+        for corner in product((0, 1), repeat=len(axes)):
+            index = [slice(None)] * table.ndim
+            for axis, end in zip(axes, corner):
+                index[axis] = bounds[axis][end]
+            sign = -1 if (len(axes) - sum(corner)) % 2 else 1
+            total = total + sign * table[tuple(index)]
+        # The other axes are still cumulative
+        for axis in range(np.ndim(total)):
+            total = np.diff(total, axis=axis)
+        return total
+
+    def mean(self, ds, positions):
+        """
+        Mean of ds over the positions, like ds.isel(positions).mean(list(positions)).
+        :param ds: DataArray or Dataset with variables of the indexed data
+        :param positions: dict of dimension and slice of positions, e.g. from slice_positions
+        :raises KeyError, ValueError: If ds does not match the index or the positions are not contiguous
+        """
+        if isinstance(ds, DataArray):
+            return self.mean_variable(ds, positions)
+        return Dataset({name: self.mean_variable(x, positions) for name, x in ds.data_vars.items()})
+
+    def mean_variable(self, array, positions):
+        if self.dims[array.name] != array.dims or self.shapes[array.name] != array.shape:
+            raise ValueError(f'{array.name} does not match the index')
+        bounds = {}
+        for x, value in positions.items():
+            if x not in array.dims:
+                continue
+            if not isinstance(value, slice):
+                raise ValueError(f'Selection of {x} is not a slice')
+            start, stop, step = value.indices(array.sizes[x])
+            if step != 1:
+                raise ValueError(f'Selection of {x} is not contiguous')
+            bounds[array.dims.index(x)] = (start, max(start, stop))
+        sums, counts = self.tables[array.name]
+        total = self.box(sums, bounds)
+        count = self.box(counts, bounds)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.where(count > 0, total / count, np.nan)
+        dims = [x for i, x in enumerate(array.dims) if i not in bounds]
+        coords = {name: coord for name, coord in array.coords.items() if set(coord.dims) <= set(dims)}
+        return DataArray(values, dims=dims, coords=coords, name=array.name)
+
+    def save(self, path):
+        """Save the tables to a sidecar .npz file."""
+        names = list(self.tables)
+        arrays = {}
+        for i, name in enumerate(names):
+            arrays[f'sums_{i}'], arrays[f'counts_{i}'] = self.tables[name]
+        meta = {'names': names, 'dims': [self.dims[x] for x in names], 'shapes': [self.shapes[x] for x in names]}
+        with open(path, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+
+    @classmethod
+    def load(cls, path, data):
+        """
+        Load the tables of data from a sidecar file written by save.
+        :return: PrefixSumIndex, or None if the file does not exist or does not match data. The number of values and
+        the total of each variable are compared with data.
+        """
+        if not pl.Path(path).exists():
+            return None
+        variables = {data.name: data} if isinstance(data, DataArray) else dict(data.data_vars)
+        with np.load(path) as f:
+            meta = json.loads(str(f['meta']))
+            if meta['names'] != [str(x) if x is not None else x for x in variables]:
+                return None
+            tables = {}
+            for i, (name, x) in enumerate(variables.items()):
+                if tuple(meta['dims'][i]) != tuple(x.dims) or tuple(meta['shapes'][i]) != tuple(x.shape):
+                    return None
+                sums, counts = f[f'sums_{i}'], f[f'counts_{i}']
+                values = np.asarray(x.values, dtype=np.float64)
+                corner = (-1,) * values.ndim
+                if counts[corner] != np.count_nonzero(~np.isnan(values)) or \
+                        not np.isclose(sums[corner], np.nansum(values)):
+                    return None
+                tables[name] = (sums, counts)
+        return cls(data, tables)
+
+
+class ReductionCache:
+    def __init__(self, max_bytes=2**28):
+        """
+        Least recently used cache of the means over the hyper_slice, which is shared by all views of an Explorer.
+        The labels of the slices are quantized to the integer positions which they select, so that all rectangles
+        selecting the same data points give the same entry. Results are computed into memory.
+        :param max_bytes: Maximum size of the cached results. Older entries are evicted first.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def reduce(self, ds, hyper_slice, remaining_dims, index=None):
+        red_slice = {x: value for x, value in hyper_slice.items() if x not in remaining_dims}
+        try:
+            positions = slice_positions(ds, red_slice)
+        except (KeyError, TypeError, ValueError):
+            return reduce_ds(ds, hyper_slice, remaining_dims)
+        source = ('da', ds.name) if isinstance(ds, DataArray) else ('ds', tuple(ds.data_vars))
+        key = (source, tuple(remaining_dims),
+               tuple((x, (p.start, p.stop, p.step) if isinstance(p, slice) else repr(p)) for x, p in positions.items()))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        result = None
+        if index is not None:
+            try:
+                result = index.mean(ds, positions)
+            except (KeyError, ValueError):
+                pass
+        if result is None:
+            result = ds.isel(positions).mean(list(positions)).compute()
+        if result.nbytes <= self.max_bytes:
+            self.entries[key] = result
+            self.nbytes += result.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return result
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+
 def broadcast_ds(ds):
     return merge(broadcast(*[ds[var] for var in ds.data_vars.keys()]))
 
 class SlicePlot1D:
-    def __init__(self, da, dim, update_method, orientation, var=None, plot_kwargs=None):
+    def __init__(self, da, dim, update_method, orientation, var=None, plot_kwargs=None, cache=None, index=None):
+        self.cache = cache
+        self.index = index
         if plot_kwargs is not None:
             self.plot_kwargs = plot_kwargs.copy()
         else:
@@ -150,35 +361,20 @@ class SlicePlot1D:
         self.update_plot()
 
     def reduced_da(self):
-        red_slice = self.update_method().copy()
-        del (red_slice[self.dim])
-        da = self.da
-        for x in red_slice.keys():
-            if x in self.da.coords.keys():
-                da = da.sel({x: red_slice[x]})
-            else:
-                da = da.isel({x: red_slice[x]})
-        da = da.mean(list(red_slice.keys()))
-        return da
+        return reduce_ds(self.da, self.update_method(), [self.dim], self.cache, self.index)
 
     def format_ds(self):
-        red_slice = self.update_method().copy()
-        del (red_slice[self.dim])
-
-        ds = self.ds
-        for x in red_slice.keys():
-            if x in self.da.coords.keys():
-                ds = ds.sel({x: red_slice[x]})
-            else:
-                ds = ds.isel({x: red_slice[x]})
-        ds = ds.mean(list(red_slice.keys()))
+        ds = reduce_ds(self.ds, self.update_method(), [self.dim], self.cache, self.index)
 
         test = broadcast(*[ds[var] for var in ds.data_vars.keys()])
         return list(test)
 
 
 class SlicePlot:
-    def __init__(self, da, ax, x_dim, y_dim, update_method, var=None, fig=None, plot_kwargs=None):
+    def __init__(self, da, ax, x_dim, y_dim, update_method, var=None, fig=None, plot_kwargs=None, cache=None,
+                 index=None):
+        self.cache = cache
+        self.index = index
         fig.canvas.mpl_connect('key_press_event', self.on_key_press)
         if plot_kwargs is None:
             plot_kwargs = {}
@@ -235,20 +431,16 @@ class SlicePlot:
                                     interactive=True,
                                     props=dict(facecolor='red', edgecolor='black', alpha=0.05, fill=True))
         self.grid_lock = False
+        # With a PrefixSumIndex, the other views follow the rectangle while it is dragged. The handlers are connected
+        # after the RectangleSelector, so that its extents are already updated when they are called.
+        self.dragging = False
+        self.fig.canvas.mpl_connect('button_press_event', self.on_press)
+        self.fig.canvas.mpl_connect('button_release_event', self.on_release)
+        self.fig.canvas.mpl_connect('motion_notify_event', self.on_drag)
         self.set_rectangle(self.update_method())
 
     def reduced_da(self):
-        red_slice = self.update_method().copy()
-        for i in [self.x_dim, self.y_dim]:
-            del(red_slice[i])
-        da = self.da
-        for x in red_slice.keys():
-            if x in self.da.coords.keys():
-                da = da.sel({x: red_slice[x]})
-            else:
-                da = da.isel({x: red_slice[x]})
-        da = da.mean(list(red_slice.keys()))
-        return da
+        return reduce_ds(self.da, self.update_method(), [self.x_dim, self.y_dim], self.cache, self.index)
 
     def on_click_xline(self, event):
         if self.mode == 'ds':
@@ -257,7 +449,8 @@ class SlicePlot:
             data = self.da
         else:
             raise AttributeError('SlicePlot.mode must be "da" or "ds"')
-        self.spx = SlicePlot1D(data, self.x_dim, self.update_method, 'x', var=self.var)
+        self.spx = SlicePlot1D(data, self.x_dim, self.update_method, 'x', var=self.var, cache=self.cache,
+                               index=self.index)
         self.spx.ax.sharex(self.ax)
         plt.show()
 
@@ -268,7 +461,8 @@ class SlicePlot:
             data = self.da
         else:
             raise AttributeError('SlicePlot.mode must be "da" or "ds"')
-        self.spy = SlicePlot1D(data, self.y_dim, self.update_method, 'y', var=self.var)
+        self.spy = SlicePlot1D(data, self.y_dim, self.update_method, 'y', var=self.var, cache=self.cache,
+                               index=self.index)
         self.spy.ax.sharey(self.ax)
         plt.show()
 
@@ -315,6 +509,20 @@ class SlicePlot:
     def on_scroll(self, event):
         pass
 
+    def on_press(self, event):
+        self.dragging = event.inaxes == self.ax and event.button in [1, 3]
+
+    def on_release(self, event):
+        self.dragging = False
+
+    def on_drag(self, event):
+        if self.index is None or not self.dragging or event.inaxes != self.ax:
+            return
+        ex = self.RS.extents
+        if ex[0] == ex[1] or ex[2] == ex[3]:
+            return
+        self.update_method({self.x_dim: slice(ex[0], ex[1]), self.y_dim: slice(ex[2], ex[3])})
+
     def line_select_callback(self, eclick, erelease):
         'eclick and erelease are the press and release events'
         x1, y1 = eclick.xdata, eclick.ydata
@@ -322,6 +530,10 @@ class SlicePlot:
         sl = self.update_method({self.x_dim: slice(x1, x2), self.y_dim: slice(y1, y2)})
 
     def set_rectangle(self, sl):
+        if self.dragging:
+            # The selector of this view is being dragged and already shows the selection
+            self.update_plot()
+            return
         old_extents = self.RS.extents
         x, y = sl[self.x_dim], sl[self.y_dim]
         extents_request = [x.start, x.stop, y.start, y.stop]
@@ -355,8 +567,25 @@ class SlicePlot:
 
 
 class Explorer:
-    def __init__(self, da, cuts='minimal', var=None, save_path = 'ROI.sl', plot_kwargs=None, dimensions=None):
+    def __init__(self, da, cuts='minimal', var=None, save_path = 'ROI.sl', plot_kwargs=None, dimensions=None,
+                 cache_bytes=2**28, prefix_sums=False, index_path=None):
+        """
+        :param cache_bytes: Memory limit of the means over the selection, which are cached and shared by all views.
+        None disables the cache.
+        :param prefix_sums: If True, a PrefixSumIndex is built on start, so that the mean over any rectangular selection
+        takes the same time and the views follow the rectangle while it is dragged. Needs twice the memory of the data.
+        :param index_path: Sidecar .npz file of the PrefixSumIndex. It is loaded if it matches the data, otherwise the
+        index is built and saved there. Implies prefix_sums.
+        """
         self.save_path = save_path
+        self.cache = None if cache_bytes is None else ReductionCache(cache_bytes)
+        self.index = None
+        if index_path is not None:
+            self.index = PrefixSumIndex.load(index_path, da)
+        if self.index is None and (prefix_sums or index_path is not None):
+            self.index = PrefixSumIndex(da)
+            if index_path is not None:
+                self.index.save(index_path)
         if plot_kwargs is None:
             plot_kwargs = {}
         if isinstance(da, DataArray):
@@ -410,7 +639,8 @@ class Explorer:
                     except ValueError:
                         pass
                 print('yep')
-            self.axes.append(SlicePlot(da, ax, x_dim, y_dim, self.update, var=var, fig=fig, plot_kwargs=plot_kwargs))
+            self.axes.append(SlicePlot(da, ax, x_dim, y_dim, self.update, var=var, fig=fig, plot_kwargs=plot_kwargs,
+                                       cache=self.cache, index=self.index))
 
     def close_all(self, event):
         for x in self.axes: